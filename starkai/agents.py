@@ -13,8 +13,7 @@ attackers.
 """
 
 from starkai.qfeatures import FlagSearcherFeatureProvider, FlagReturnerFeatureProvider
-from starkai.states import BotState
-from starkai.util import euclidean_dist, find_closest
+from starkai.util import find_closest
 from api.gameinfo import MatchCombatEvent
 from api.commands import Move, Attack, Charge
 from api.vector2 import Vector2
@@ -47,11 +46,11 @@ class Northman(object):
 		self.living_penalty = living_penalty
 		self.commander = commander
 
-		self.last_state = BotState(self.bot.position.x, self.bot.position.y)
+		self.last_state = self.commander.state.bot_state(self.bot.position.x, self.bot.position.y)
 		self.last_action = None
 
 		# Find distance to flag
-		self.flag_distance = find_closest([(flag.position.x, flag.position.y) for flag in self.commander.game.enemyFlags], self.last_state)
+		self.flag_distance = self.commander.distances.closest([(flag.position.x, flag.position.y) for flag in self.commander.game.enemyFlags], self.last_state)
 
 	@classmethod
 	def set_qlearner(cls, qlearner):
@@ -66,7 +65,7 @@ class Northman(object):
 			this command is executed. When it returns None, nothing is done.
 		"""
 
-		state = BotState(self.bot.position.x, self.bot.position.y)
+		state = self.commander.state.bot_state(self.bot.position.x, self.bot.position.y)
 		reward = self.calculate_reward(state, event)
 
 		if state != self.last_state and self.last_action and reward:
@@ -78,11 +77,11 @@ class Northman(object):
 			action = self.qlearner.get_action(state)
 			self.last_action = action
 
-			# Find closest enemy
-			min_enemy_dist = find_closest(
-				[(bot.position.x, bot.position.y) for bot in self.commander.game.enemyTeam.members if bot.seenlast < 5 and bot.health > 0],
-				state
-			)
+			# Find closest enemy which is actually in sight, the lines to all enemies are traced at once
+			position = (self.bot.position.x, self.bot.position.y)
+			enemies = [(bot.position.x, bot.position.y) for bot in self.commander.game.enemyTeam.members if bot.seenlast < 5 and bot.health > 0]
+			in_sight = self.commander.visibility_table.lines_of_sight([position] * len(enemies), enemies)
+			min_enemy_dist = find_closest([enemy for enemy, visible in zip(enemies, in_sight) if visible], state)
 
 			if self.commander.enemy_influence.get_influence(state) < 0.1 or not min_enemy_dist < self.commander.level.firingDistance:
 				return Charge(self.bot.name, Vector2(state[0] + action[0]+0.5, state[1] + action[1]+0.5), "running")
@@ -101,7 +100,7 @@ class Northman(object):
 
 		if not event:
 			# Return reward based on the distance of the flag
-			min_flag_dist = find_closest([(flag.position.x, flag.position.y) for flag in self.commander.game.enemyFlags], state)
+			min_flag_dist = self.commander.distances.closest([(flag.position.x, flag.position.y) for flag in self.commander.game.enemyFlags], state)
 			difference = self.flag_distance**2 - min_flag_dist**2
 
 			self.flag_distance = min_flag_dist
@@ -134,7 +133,7 @@ class FlagReturner(Northman):
 
 		# Distance to score location
 		score_loc = self.commander.game.team.flagScoreLocation
-		self.score_dist = euclidean_dist((score_loc.x, score_loc.y), self.last_state)
+		self.score_dist = self.commander.distances.distance((score_loc.x, score_loc.y), self.last_state)
 
 	def calculate_reward(self, state, event=None):
 		"""
@@ -147,7 +146,7 @@ class FlagReturner(Northman):
 		if not event:
 			# Return reward based on the distance of the flag score location
 			score_loc = self.commander.game.team.flagScoreLocation
-			distance = euclidean_dist((score_loc.x, score_loc.y), state)
+			distance = self.commander.distances.distance((score_loc.x, score_loc.y), state)
 			difference = self.score_dist**2 - distance**2
 
 			self.score_dist = distance
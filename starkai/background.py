@@ -0,0 +1,140 @@
+"""
+:mod:`starkai.background` - Background influence map updates
+=============================================================
+
+This module contains a class which propagates an influence stack in a
+background thread, so the commander doesn't have to wait for it while
+issuing commands.
+
+.. module:: starkai.background
+   :synopsis: Background influence map updates
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+
+import sys
+import threading
+import numpy
+
+from starkai.influencemap import BufferPool, InfluenceStack
+
+class BackgroundUpdater(object):
+	"""
+		Double buffered updates of an :class:`~starkai.influencemap.InfluenceStack`.
+
+		The stack itself is the front buffer, which is read by agents and
+		feature providers, and receives new influence sources. When an
+		update is scheduled, the front buffer is copied to a back buffer,
+		which is propagated by a worker thread. The next call to
+		:meth:`poll` swaps both buffers, so the values read are at most
+		one update behind.
+	"""
+
+	def __init__(self, stack):
+		self.front = stack
+		self.back = InfluenceStack(stack.topology, [(layer.decay, layer.momentum) for layer in stack.layers],
+			pool=BufferPool())
+
+		self._arguments = None
+		self._busy = False
+		self._error = None
+		self._stopped = False
+
+		self._scheduled = threading.Event()
+		self._finished = threading.Event()
+
+		self._thread = threading.Thread(target=self._run, name="influence-updater")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _run(self):
+		while True:
+			self._scheduled.wait()
+			self._scheduled.clear()
+
+			if self._stopped:
+				break
+
+			# An exception is handed to the next poll(), instead of silently stopping the updates
+			try:
+				self.back.update_map(*self._arguments)
+			except Exception:
+				self._error = sys.exc_info()
+
+			self._finished.set()
+
+	def poll(self):
+		"""
+			Swaps the front and back buffers if the worker has finished an
+			update. Call this before setting new influence sources. Returns
+			True if the buffers were swapped.
+
+			If the update raised an exception in the worker, the buffers
+			are not swapped and the exception is raised here. The next
+			update can be scheduled as usual.
+		"""
+
+		if not self._finished.is_set():
+			return False
+
+		self._finished.clear()
+
+		if self._error is not None:
+			error, self._error = self._error, None
+			self._busy = False
+
+			raise error[0], error[1], error[2]
+
+		self.front.values, self.back.values = self.back.values, self.front.values
+		self.front.dirty, self.back.dirty = self.back.dirty, self.front.dirty
+
+		# Keep the sources and dirty cells set since the update was scheduled
+		numpy.logical_or(self.front.dirty, self.back.dirty, out=self.front.dirty)
+
+		for layer in self.front.layers:
+			for cell, influence in layer._sources.iteritems():
+				self.front.values[layer.index, cell] = influence
+
+			layer.version += 1
+
+		self._busy = False
+
+		return True
+
+	def schedule(self, num_times=1, incremental=False, threshold=1e-4):
+		"""
+			Starts propagating a copy of the front buffer in the background,
+			see :meth:`~starkai.influencemap.InfluenceStack.update_map` for
+			the arguments. Does nothing if the previous update hasn't been
+			swapped in yet, and returns False in that case.
+		"""
+
+		if self._busy:
+			return False
+
+		numpy.copyto(self.back.values, self.front.values)
+		numpy.copyto(self.back.dirty, self.front.dirty)
+
+		for front_layer, back_layer in zip(self.front.layers, self.back.layers):
+			back_layer.decay = front_layer.decay
+			back_layer.momentum = front_layer.momentum
+			back_layer.propagation = front_layer.propagation
+			back_layer.max_sweeps = front_layer.max_sweeps
+
+			# The sources set since the previous update are handed over as well
+			back_layer._sources, front_layer._sources = front_layer._sources, {}
+
+		self._busy = True
+		self._arguments = (num_times, incremental, threshold)
+		self._scheduled.set()
+
+		return True
+
+	def stop(self):
+		"""
+			Stops the worker thread
+		"""
+
+		self._stopped = True
+		self._scheduled.set()
+		self._thread.join()
@@ -11,23 +11,31 @@ The classes in this module control all the bots in a certain game
 """
 from __future__ import division
 from math import floor, exp
-import random
 import sys
+import numpy
 from datetime import datetime
 
 from api import Commander
-from api import Vector2
 from api.gameinfo import MatchCombatEvent
 
 from starkai import agents, qvalues
-from starkai.influencemap import GridInfluenceMap
-from starkai.visibility import Wave
+from starkai.background import BackgroundUpdater
+from starkai.distancefield import DistanceFields
+from starkai.influencemap import BufferPool, GridTopology, InfluenceStack
+from starkai.visibilitytable import VisibilityTable
 from starkai.qlearner import ApproximateQLearner
+from starkai.threatmap import ThreatMap
 from starkai.states import GameState
 from starkai.util import Counter
 
 DEBUG = True
 
+# Propagate influence maps in a background thread, instead of during the tick
+BACKGROUND_UPDATES = True
+
+# Build a missing visibility table with a pool of worker processes
+PARALLEL_VISIBILITY = True
+
 if DEBUG:
 	try:
 		from starkai.visualizer import VisualizerWindow
@@ -46,69 +54,64 @@ class RobbStarkCommander(Commander):
 		self.last_event_index = 0
 
 		# Setup some influence maps
-		self.my_influence = GridInfluenceMap(0.2, 0.5, self.level.width, self.level.height,
-			is_blocked=self.state.is_blocked)
-		self.enemy_influence = GridInfluenceMap(0.1, 0.6, self.level.width, self.level.height,
-			is_blocked=self.state.is_blocked)
-		self.goal_influence = GridInfluenceMap(0.01, 0.9, self.level.width, self.level.height,
-			is_blocked=self.state.is_blocked)
-
-		print "Calculating influence maps..."
-		i = 0
-		while i < 5:
-			for bot in self.game.bots_alive:
-				self.my_influence.set_influence((floor(bot.position.x), floor(bot.position.y)), 1.0)
+		self.topology = GridTopology(self.level.width, self.level.height, ~self.state.blocked)
 
-			# If there are some enemy bots visible at the beginning, add them to the influence map
-			for bot in self.game.enemyTeam.members:
-				if bot.health > 0:
-					self.enemy_influence.set_influence((floor(bot.position.x), floor(bot.position.y)), 1.0)
+		# Temporary arrays are reused each tick
+		self.buffers = BufferPool()
 
-			for flag in self.game.enemyFlags:
-				self.goal_influence.set_influence((floor(flag.position.x), floor(flag.position.y)), 1.0)
+		# All maps are stored in a single stack, so they can be propagated in one pass
+		self.influence_stack = InfluenceStack(self.topology, [
+			(0.2, 0.5),
+			(0.1, 0.6),
+			(0.01, 0.9)
+		], pool=self.buffers)
+		self.my_influence, self.enemy_influence, self.goal_influence = self.influence_stack.layers
 
-			# Let the values propagate a bit
-			self.my_influence.update_map()
-			self.enemy_influence.update_map()
-			self.goal_influence.update_map()
-			i += 1
+		# Goal influence spreads over almost the whole level, which takes a few line sweeps instead of many iterations
+		self.goal_influence.propagation = 'sweep'
 
-			print i
-
-		# Calculate visibility map
-		print "Calculating visibility map..."
-		self.visibility = Counter()
+		# Combined maps are lazy views, evaluated when read
+		self._influence = self.my_influence.lazy() - self.enemy_influence
+		self._final_influence = (self._influence + self.goal_influence) / 2
 
-		max_visibility = 0
-		for i in range(1000):
-			point = Vector2(random.randint(0, self.level.width - 1), random.randint(0, self.level.height - 1))
+		print "Calculating influence maps..."
+		for bot in self.game.bots_alive:
+			self.my_influence.set_influence((floor(bot.position.x), floor(bot.position.y)), 1.0)
 
-			visible_cells = []
+		# If there are some enemy bots visible at the beginning, add them to the influence map
+		for bot in self.game.enemyTeam.members:
+			if bot.health > 0:
+				self.enemy_influence.set_influence((floor(bot.position.x), floor(bot.position.y)), 1.0)
 
-			def visible(p):
-				delta = (p-point)
-				l = delta.length()
+		for flag in self.game.enemyFlags:
+			self.goal_influence.set_influence((floor(flag.position.x), floor(flag.position.y)), 1.0)
 
-				return l <= 15.0
+		# Let the values propagate until they have converged
+		self.influence_stack.steady_state()
 
-			wave = Wave((self.level.width, self.level.height),
-				lambda x, y: self.level.blockHeights[x][y] > 1,
-				lambda x, y: visible_cells.append((x, y))
-			)
+		# Calculate visibility map, the table is cached per level
+		print "Calculating visibility map..."
+		self.visibility_table = VisibilityTable.load(self.level.width, self.level.height, self.state.blocks_sight,
+			processes=None if PARALLEL_VISIBILITY else 1)
 
-			wave.compute(point)
+		coverage = self.visibility_table.coverage(15.0)
+		max_visibility = max(coverage.max(), 1)
 
-			for x, y in [c for c in visible_cells if visible(Vector2(c[0]+0.5, c[1]+0.5))]:
-				self.visibility[(x, y)] += 1
+		self.visibility = Counter()
+		for x, y in zip(*numpy.nonzero(coverage)):
+			self.visibility[(int(x), int(y))] = coverage[x, y] / max_visibility
 
-				max_visibility = max(self.visibility[(x, y)], max_visibility)
+		print " finished"
 
-			if i % 100 == 0:
-				print ".",
+		# Path distances to the flag spawns and score locations, for the rewards and features
+		targets = self.level.flagSpawnLocations.values() + self.level.flagScoreLocations.values()
+		self.distances = DistanceFields(~self.state.blocked, [(target.x, target.y) for target in targets])
 
-		self.visibility.divide_all(max_visibility)
+		# Cells the visible enemies can fire at, rebuilt each tick
+		self.threat = ThreatMap(self.level.width, self.level.height, self.visibility_table.blocked, self.level.firingDistance)
 
-		print " finished"
+		# Started after the visibility table is built, its worker processes shouldn't be forked from a threaded process
+		self.updater = BackgroundUpdater(self.influence_stack) if BACKGROUND_UPDATES else None
 
 		# Initialize roles for each bot
 		self.learners = {}
@@ -138,11 +141,11 @@ class RobbStarkCommander(Commander):
 
 	@property
 	def influence(self):
-		return self.my_influence - self.enemy_influence
+		return self._influence
 
 	@property
 	def final_influence(self):
-		return (self.influence + self.goal_influence) / 2
+		return self._final_influence
 
 	def tick(self):
 		"""
@@ -150,12 +153,19 @@ class RobbStarkCommander(Commander):
 		"""
 
 		self.counter += 1
+		self.state.update()
 
 		for bot in self.game.bots_alive:
 			if not bot.name in self.roles:
 				self.roles[bot.name] = agents.Northman(bot, self, -0.5)
 
-		# Update influence maps
+		# Continue computing path distances to targets which moved, like a carried flag
+		self.distances.update()
+
+		# Update influence maps, swap in the results of the background update first
+		if self.updater:
+			self.updater.poll()
+
 		for bot in self.game.bots_alive:
 			self.my_influence.set_influence((floor(bot.position.x), floor(bot.position.y)), 1.0)
 
@@ -167,11 +177,17 @@ class RobbStarkCommander(Commander):
 		for flag in self.game.enemyFlags:
 			self.goal_influence.set_influence((floor(flag.position.x), floor(flag.position.y)), 1.0)
 
+		self.threat.update(
+			((bot.position.x, bot.position.y), (bot.facingDirection.x, bot.facingDirection.y) if bot.facingDirection else None, self.field_of_view(bot))
+			for bot in self.game.enemyTeam.members if bot.health > 0 and bot.seenlast < 5
+		)
+
 		if self.counter >= 2:
 			print "update maps"
-			self.my_influence.update_map()
-			self.enemy_influence.update_map()
-			self.goal_influence.update_map()
+			if self.updater:
+				self.updater.schedule(incremental=True)
+			else:
+				self.influence_stack.update_map(incremental=True)
 
 			self.counter = 0
 
@@ -224,6 +240,17 @@ class RobbStarkCommander(Commander):
 		if DEBUG:
 			self.window.tick()
 
+	def field_of_view(self, bot):
+		"""
+			Returns the field of view angle of a bot in its current state,
+			or None if it isn't known
+		"""
+
+		try:
+			return self.level.fieldOfViewAngles[bot.state]
+		except (IndexError, KeyError, TypeError):
+			return None
+
 	def alpha(self):
 		"""
 			Returns the learning rate based on the time elapsed
@@ -280,6 +307,9 @@ class RobbStarkCommander(Commander):
 			print >>sys.stderr, code
 			print >>sys.stderr, "-" * 15
 
+		if self.updater:
+			self.updater.stop()
+
 		if DEBUG:
 			del self.window
 
@@ -0,0 +1,240 @@
+"""
+:mod:`starkai.distancefield` - Path distances to fixed targets
+==============================================================
+
+This module contains distance fields, which store the length of the
+shortest path over the walkable cells from each cell to a target, like
+a flag spawn or score location.
+
+.. module:: starkai.distancefield
+   :synopsis: Path distance fields
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+from __future__ import division
+from itertools import chain
+import heapq
+import math
+import sys
+import numpy
+
+from starkai.util import euclidean_dist, LRUCache
+from starkai.visibilitytable import fingerprint
+
+# Moves between cells with their length, diagonals may not cut corners
+MOVES = (
+	(1, 0, 1.0), (-1, 0, 1.0), (0, 1, 1.0), (0, -1, 1.0),
+	(1, 1, math.sqrt(2)), (1, -1, math.sqrt(2)), (-1, 1, math.sqrt(2)), (-1, -1, math.sqrt(2))
+)
+
+# Fields computed before, by level fingerprint and target cell
+_fields = {}
+
+def distance_field(walkable, target):
+	"""
+		Returns an array of the same shape as `walkable` with the path
+		distance from each cell to the `target` cell, or infinity for
+		cells from which the target can't be reached. Moves go to the 8
+		neighbouring cells, without cutting corners of blocked cells.
+	"""
+
+	distances = [float('inf')] * walkable.size
+	for i in search(walkable, target, distances):
+		pass
+
+	return numpy.array(distances).reshape(walkable.shape)
+
+def search(walkable, target, distances):
+	"""
+		Generator which computes the distance field of `target` into the
+		flat list `distances`, see :func:`distance_field`. It yields after
+		each cell which gets its final distance, so the search can be
+		spread over several calls.
+	"""
+
+	width, height = walkable.shape
+	free = walkable.ravel().tolist()
+
+	start = target[0]*height + target[1]
+	if not free[start]:
+		return
+
+	distances[start] = 0.0
+	queue = [(0.0, target[0], target[1])]
+
+	while queue:
+		distance, x, y = heapq.heappop(queue)
+		if distance > distances[x*height + y]:
+			continue
+
+		for dx, dy, length in MOVES:
+			nx, ny = x + dx, y + dy
+			if nx < 0 or ny < 0 or nx >= width or ny >= height or not free[nx*height + ny]:
+				continue
+
+			if dx and dy and not (free[nx*height + y] and free[x*height + ny]):
+				continue
+
+			new_distance = distance + length
+			if new_distance < distances[nx*height + ny]:
+				distances[nx*height + ny] = new_distance
+				heapq.heappush(queue, (new_distance, nx, ny))
+
+		yield
+
+class DistanceFields(object):
+	"""
+		Distance fields for a set of targets on a level. Fields are cached
+		per level, so they are only computed once per process.
+
+		Fields for other target cells, like a flag which is being carried,
+		are computed by :meth:`update`, a limited number of cells per call,
+		so they don't slow down a tick. Until the field of a cell is done,
+		the field of the closest cell which is done is used, if that is
+		within `slack` cells. The most recently used of those fields are
+		kept.
+	"""
+
+	def __init__(self, walkable, targets, capacity=64, budget=1024, slack=8.0):
+		"""
+			:Arguments:
+				* walkable: Boolean array of shape (width, height), True for cells which can be entered
+				* targets: Iterable of (x, y) positions to compute fields for
+				* capacity: Number of fields kept for cells which aren't one of the targets
+				* budget: Number of cells searched per call to :meth:`update`
+				* slack: Maximum distance between a cell and the cell of the field used until its own is done
+		"""
+
+		self.walkable = numpy.asarray(walkable, dtype=bool)
+		self.width, self.height = self.walkable.shape
+
+		level = fingerprint(self.width, self.height, ~self.walkable)
+
+		self.fields = {}
+		for target in targets:
+			cell = (int(target[0]), int(target[1]))
+
+			key = (level, cell)
+			if key not in _fields:
+				_fields[key] = distance_field(self.walkable, cell)
+
+			self.fields[cell] = _fields[key]
+
+		self.extra = LRUCache(capacity)
+		self.budget = budget
+		self.slack = slack
+
+		# Cells asked for without a field since the last update, in order
+		self.requested = []
+
+		# Field used for each requested cell until its own is done
+		self.estimates = {}
+
+		# Cell, flat distances and generator of the search in progress
+		self.pending = None
+
+	def get_field(self, target):
+		"""
+			Returns the distance field for the cell of `target`. If it
+			isn't computed yet, the field of a nearby cell is returned and
+			the cell is queued for :meth:`update`. Returns None if the cell
+			is outside the level or blocked, or no nearby field is known.
+		"""
+
+		cell = (int(target[0]), int(target[1]))
+
+		field = self.fields.get(cell)
+		if field is None:
+			field = self.extra.get(cell)
+
+		if field is None:
+			x, y = cell
+			if not (0 <= x < self.width and 0 <= y < self.height and self.walkable[x, y]):
+				return None
+
+			if cell not in self.estimates:
+				self.requested.append(cell)
+				self.estimates[cell] = self.nearest(cell)[0]
+
+			field = self.estimates[cell]
+
+		return field
+
+	def nearest(self, cell):
+		"""
+			Returns the computed field whose cell is closest to `cell` and
+			the distance between both cells, or None and infinity if there
+			is none within `slack` cells.
+		"""
+
+		field, min_dist = None, float('inf')
+		for other, other_field in chain(self.fields.iteritems(), self.extra.iteritems()):
+			dist = euclidean_dist(cell, other)
+
+			if dist <= self.slack and dist < min_dist:
+				field, min_dist = other_field, dist
+
+		return field, min_dist
+
+	def update(self):
+		"""
+			Continues computing the fields of the cells asked for since
+			the last update, for at most `budget` cells. Should be called
+			once per tick.
+		"""
+
+		budget = self.budget
+		while budget > 0:
+			if self.pending is None:
+				cells = [cell for cell in self.requested if cell not in self.extra]
+				if not cells:
+					break
+
+				# The cell without a field nearby goes first, so two moving targets take turns
+				cell = max(cells, key=lambda other: self.nearest(other)[1])
+				distances = [float('inf')] * self.walkable.size
+				self.pending = (cell, distances, search(self.walkable, cell, distances))
+
+			cell, distances, steps = self.pending
+			for i in steps:
+				budget -= 1
+				if budget <= 0:
+					break
+			else:
+				self.extra[cell] = numpy.array(distances).reshape(self.walkable.shape)
+				self.pending = None
+
+		# Cells not asked for again are outdated, a moving target is somewhere else by now
+		self.requested = []
+		self.estimates.clear()
+
+	def distance(self, target, position):
+		"""
+			Returns the path distance between `position` and `target`. While
+			the field of `target` isn't computed, this is the distance to a
+			nearby cell, see :meth:`get_field`. If either is off the walkable
+			grid, no nearby field is known, or the target can't be reached,
+			the euclidean distance is returned instead.
+		"""
+
+		field = self.get_field(target)
+		x, y = int(position[0]), int(position[1])
+
+		if field is not None and 0 <= x < self.width and 0 <= y < self.height:
+			distance = field.item(x, y)
+
+			if distance != float('inf'):
+				return distance
+
+		return euclidean_dist(target, position)
+
+	def closest(self, targets, position):
+		"""
+			Like :func:`starkai.util.find_closest`, but with path distances
+		"""
+
+		min_dist = sys.maxint
+		for target in targets:
+			min_dist = min(min_dist, self.distance(target, position))
+
+		return min_dist
@@ -2,7 +2,10 @@
 :mod:`starkai.influencemap` - Module with an influencemap implementation
 =======================================================================
 
-This module contains a class for creating and modifying influence maps.
+This module contains classes for creating and modifying influence maps.
+:class:`GridInfluenceMap` stores its values in a dictionary, while
+:class:`DenseGridInfluenceMap` uses a NumPy array for faster updates on
+larger levels.
 
 .. module:: starkai.influencemap
    :synopsis: Infuence map implementations
@@ -12,7 +15,10 @@ This module contains a class for creating and modifying influence maps.
 
 from starkai.util import Counter, lerp
 from abc import ABCMeta, abstractmethod
+import heapq
 import math
+import operator
+import numpy
 
 class BaseInfluenceMap(object):
 	"""
@@ -49,10 +55,10 @@ class BaseInfluenceMap(object):
 			the new values for each point
 		"""
 		
-		new_influence = {}
-
 		i = 0
 		while i < num_times:
+			new_influence = {}
+
 			for position in self.influence:
 				max_infl = 0.0
 
@@ -63,82 +69,236 @@ class BaseInfluenceMap(object):
 
 				new_influence[position] = lerp(self.get_influence(position), max_infl, self.momentum)
 
+			# Each iteration continues from the values of the previous one
+			del self.influence
+			self.influence = new_influence
+
 			i += 1
-		
-		del self.influence
-		self.influence = new_influence
+
+	def steady_state(self, threshold=1e-4):
+		"""
+			Computes the converged influence map in a single pass, instead
+			of calling :meth:`update_map` until the values stop changing.
+
+			At the fixed point of the update rule, each position has the
+			maximum over all current influences, decayed with the shortest
+			path distance to that position. This is calculated with a
+			multi-source Dijkstra search, seeded with all positions with
+			an influence above `threshold`.
+		"""
+
+		best = dict((position, value) for position, value in self.influence.iteritems() if value > threshold)
+		queue = [(-value, position) for position, value in best.iteritems()]
+		heapq.heapify(queue)
+
+		while queue:
+			value, position = heapq.heappop(queue)
+			value = -value
+
+			# Skip outdated entries
+			if value < best[position]:
+				continue
+
+			for neighbour, distance in self.get_neighbours(position):
+				influence = value * math.exp(-distance * self.decay)
+
+				if influence > threshold and influence > best.get(neighbour, 0.0):
+					best[neighbour] = influence
+					heapq.heappush(queue, (-influence, neighbour))
+
+		self.influence.update(best)
 	
-	def __add__(self, other):
+	def get_items(self):
 		"""
-			Adds two influence maps to each other, and returns an union
-			of keys of both maps
-			
+			Returns (position, value) pairs for all cells this map stores
+			a value for.
+		"""
+
+		return self.influence.iteritems()
+
+	def get_values(self):
+		"""
+			Returns the values of all cells as array of shape (width, height),
+			only available for maps on a grid.
+		"""
+
+		values = numpy.zeros((self.width, self.height))
+
+		for position, value in self.influence.iteritems():
+			x, y = int(position[0]), int(position[1])
+
+			if 0 <= x < self.width and 0 <= y < self.height:
+				values[x, y] = value
+
+		return values
+
+	def like(self):
+		"""
+			Returns a new, empty map of the same type
+
 			The new map has default values for decay and momentum
 		"""
 
-		new_map = self.__class__(self.decay, self.momentum)
-		
-		for key in self.influence:
-			new_map.influence[key] = self.influence[key] + other.get_influence(key)
-		
-		for key in other.influence:
-			if not key in self.influence:
-				new_map.influence[key] = other.influence[key]
-		
-		return new_map
-		
-	def __sub__(self, other):
+		return self.__class__(self.decay, self.momentum)
+
+	def add(self, other, out=None):
 		"""
 			Adds two influence maps to each other, and returns an union
-			of keys of both maps
-			
-			The new map has default values for decay and momentum
+			of keys of both maps.
+
+			The result is stored in `out`, which may be this map itself.
+			If not given, a new map is created with :meth:`like`.
 		"""
 
-		new_map = self.__class__(self.decay, self.momentum)
-		
-		for key in self.influence:
-			new_map.influence[key] = self.influence[key] - other.get_influence(key)
-		
-		for key in other.influence:
+		if out is None:
+			out = self.like()
+
+		for key, value in self.influence.items():
+			out.influence[key] = value + other.get_influence(key)
+
+		for key, value in other.get_items():
 			if not key in self.influence:
-				new_map.influence[key] = other.influence[key]
-		
-		return new_map
-	
-	def __mul__(self, scalar):
+				out.influence[key] = value
+
+		out._changed()
+
+		return out
+
+	def subtract(self, other, out=None):
 		"""
-			Multiplies each element with the given scalar
+			Subtracts another influence map from this one, and returns an
+			union of keys of both maps. See :meth:`add` for `out`.
 		"""
 
-		new_map = self.__class__(self.decay, self.momentum)
-		
-		for key in self.influence:
-			new_map.influence[key] = self.influence[key] * scalar
-		
-		return new_map
+		if out is None:
+			out = self.like()
 
-	def __div__(self, scalar):
+		for key, value in self.influence.items():
+			out.influence[key] = value - other.get_influence(key)
+
+		for key, value in other.get_items():
+			if not key in self.influence:
+				out.influence[key] = -value
+
+		out._changed()
+
+		return out
+
+	def multiply(self, scalar, out=None):
 		"""
-			Divides each element with the given scalar
+			Multiplies each element with the given scalar. See :meth:`add`
+			for `out`.
 		"""
 
-		new_map = self.__class__(self.decay, self.momentum)
+		if out is None:
+			out = self.like()
 
-		for key in self.influence:
-			new_map.influence[key] = self.influence[key] / scalar
+		for key, value in self.influence.items():
+			out.influence[key] = value * scalar
 
-		return new_map
+		out._changed()
+
+		return out
+
+	def divide(self, scalar, out=None):
+		"""
+			Divides each element with the given scalar. See :meth:`add`
+			for `out`.
+		"""
+
+		if out is None:
+			out = self.like()
+
+		for key, value in self.influence.items():
+			out.influence[key] = value / scalar
+
+		out._changed()
+
+		return out
+
+	def _changed(self):
+		"""
+			Called after the values have been overwritten by arithmetic
+		"""
+
+		pass
+
+	def __add__(self, other):
+		return self.add(other)
+
+	def __sub__(self, other):
+		return self.subtract(other)
+
+	def __mul__(self, scalar):
+		return self.multiply(scalar)
+
+	def __div__(self, scalar):
+		return self.divide(scalar)
+
+	__truediv__ = __div__
+
+	def __iadd__(self, other):
+		return self.add(other, out=self)
+
+	def __isub__(self, other):
+		return self.subtract(other, out=self)
+
+	def __imul__(self, scalar):
+		return self.multiply(scalar, out=self)
+
+	def __idiv__(self, scalar):
+		return self.divide(scalar, out=self)
+
+	__itruediv__ = __idiv__
 
 	def __getitem__(self, item):
 		return self.get_influence(item)
+
+	def lazy(self):
+		"""
+			Returns a lazy view on this map. Arithmetic on the view builds
+			an expression instead of a new map.
+		"""
+
+		return InfluenceView(operator.pos, self)
 		
+def find_walkable_cells(width, height, is_blocked):
+	"""
+		Returns a frozenset with all walkable positions on a grid. Each
+		connected component is flood filled from the first cell found in
+		it, so unreachable parts of the level are included as well.
+	"""
+
+	cells = set()
+
+	for x in xrange(width):
+		for y in xrange(height):
+			if (x, y) in cells or is_blocked((x, y)):
+				continue
+
+			cells.add((x, y))
+			queue = [(x, y)]
+			while queue:
+				position = queue.pop()
+
+				for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+					new_pos = (position[0] + dx, position[1] + dy)
+
+					if new_pos[0] < 0 or new_pos[0] >= width or new_pos[1] < 0 or new_pos[1] >= height:
+						continue
+
+					if new_pos not in cells and not is_blocked(new_pos):
+						cells.add(new_pos)
+						queue.append(new_pos)
+
+	return frozenset(cells)
+
 class GridInfluenceMap(BaseInfluenceMap):
 	"""
 		Influence map for grid based worlds
 	"""
 	
-	def __init__(self, decay=0.2, momentum=0.5, width=0, height=0, is_blocked=lambda x, y: False):
+	def __init__(self, decay=0.2, momentum=0.5, width=0, height=0, is_blocked=lambda pos: False, cells=None):
 		BaseInfluenceMap.__init__(self, decay, momentum)
 		
 		self.width = width
@@ -146,15 +306,36 @@ class GridInfluenceMap(BaseInfluenceMap):
 		
 		self.is_blocked = is_blocked
 
+		# The walkable cells are searched once, and shared by all maps created from this one
+		if cells is None:
+			cells = find_walkable_cells(width, height, is_blocked)
+
+		self.cells = cells
+
 		# Initialize counter object with all known positions
-		queue = [(0,0)]
-		checked = set()
-		while queue:
-			position = queue.pop()
-			self.set_influence(position, 0.0)
-			checked.add(position)
+		self.influence = Counter(dict.fromkeys(cells, 0.0))
+
+	def like(self):
+		"""
+			Returns a new map for the same level with all values set to
+			zero. The walkable cells are shared instead of searched again.
+		"""
+
+		new_map = self.__class__.__new__(self.__class__)
+		new_map.__dict__.update(self.__dict__)
+		new_map.influence = Counter(dict.fromkeys(self.cells, 0.0))
 
-			queue.extend([neighbour[0] for neighbour in self.get_neighbours(position) if not neighbour[0] in checked])
+		return new_map
+
+	def copy(self):
+		"""
+			Returns a copy of this map, only the values are copied.
+		"""
+
+		new_map = self.like()
+		new_map.influence.update(self.influence)
+
+		return new_map
 	
 	def get_neighbours(self, position):
 		neighbours = []
@@ -182,57 +363,1458 @@ class GridInfluenceMap(BaseInfluenceMap):
 		
 		return neighbours
 
-	def __add__(self, other):
-		new_map = self.__class__(self.decay, self.momentum, self.width, self.height, self.is_blocked)
+def _grid_items(values):
+	"""
+		Returns (position, value) pairs for the non-zero cells of an
+		array of shape (width, height).
+	"""
 
-		for key in self.influence:
-			new_map.influence[key] = self.influence[key] + other.get_influence(key)
+	xs, ys = numpy.nonzero(values)
 
-		for key in other.influence:
-			if not key in self.influence:
-				new_map.influence[key] = other.influence[key]
+	return ((position, float(values[position])) for position in zip(xs.tolist(), ys.tolist()))
 
-		return new_map
+class BufferPool(object):
+	"""
+		Small pool of NumPy arrays, so temporary buffers can be reused
+		each tick instead of being allocated again.
+	"""
 
-	def __sub__(self, other):
+	def __init__(self):
+		self.free = {}
+
+	def acquire(self, shape, dtype=float):
+		"""
+			Returns an array of the given shape and type. The contents of
+			the array are undefined.
 		"""
-			Adds two influence maps to each other, and returns an union
-			of keys of both maps
 
-			The new map has default values for decay and momentum
+		key = (tuple(shape), numpy.dtype(dtype))
+
+		if self.free.get(key):
+			return self.free[key].pop()
+
+		return numpy.empty(shape, dtype)
+
+	def release(self, *buffers):
+		"""
+			Returns the given arrays to the pool
 		"""
 
-		new_map = self.__class__(self.decay, self.momentum, self.width, self.height, self.is_blocked)
+		for buffer in buffers:
+			self.free.setdefault((buffer.shape, buffer.dtype), []).append(buffer)
 
-		for key in self.influence:
-			new_map.influence[key] = self.influence[key] - other.get_influence(key)
+class GridTopology(object):
+	"""
+		Neighbour index of a grid level, stored in compressed sparse row
+		(CSR) format. It is built once per level, and can be shared by
+		all influence maps on that level.
 
-		for key in other.influence:
-			if not key in self.influence:
-				new_map.influence[key] = other.influence[key]
+		Cells are identified by their flat index ``x * height + y``. For
+		the i-th walkable cell ``cells[i]``, its neighbours are
+		``indices[indptr[i]:indptr[i+1]]``, at the distances stored in the
+		same range of ``distances``.
+	"""
 
-		return new_map
+	# Offsets and distances of the neighbours of a cell
+	OFFSETS = (
+		(1, 0, 1.0),
+		(-1, 0, 1.0),
+		(0, 1, 1.0),
+		(0, -1, 1.0)
+	)
 
-	def __mul__(self, scalar):
+	def __init__(self, width, height, walkable, passable=None):
 		"""
-			Multiplies each element with the given scalar
+			Builds the neighbour index.
+
+			:Arguments:
+				* width, height: Dimensions of the grid
+				* walkable: Boolean array of shape (width, height), True for cells which can be entered
+				* passable: Optional boolean array of shape (len(OFFSETS), width, height), False where the move along an offset is not allowed
 		"""
 
-		new_map = self.__class__(self.decay, self.momentum, self.width, self.height, self.is_blocked)
+		self.width = width
+		self.height = height
+		self.walkable = numpy.asarray(walkable, dtype=bool).reshape((width, height))
 
-		for key in self.influence:
-			new_map.influence[key] = self.influence[key] * scalar
+		self.cells = numpy.flatnonzero(self.walkable)
+		self.blocked = numpy.flatnonzero(~self.walkable.ravel())
+		xs, ys = numpy.divmod(self.cells, height)
 
-		return new_map
+		# Row in the index for each cell, -1 for blocked cells
+		self.rows = numpy.empty(width * height, dtype=numpy.intp)
+		self.rows.fill(-1)
+		self.rows[self.cells] = numpy.arange(len(self.cells))
 
-	def __div__(self, scalar):
+		rows = []
+		neighbours = []
+		distances = []
+		for k, (dx, dy, distance) in enumerate(self.OFFSETS):
+			nx = xs + dx
+			ny = ys + dy
+			valid = (nx >= 0) & (nx < width) & (ny >= 0) & (ny < height)
+			valid[valid] = self.walkable[nx[valid], ny[valid]]
+
+			if passable is not None:
+				valid &= passable[k].ravel()[self.cells]
+
+			rows.append(numpy.flatnonzero(valid))
+			neighbours.append(nx[valid] * height + ny[valid])
+			distances.append(numpy.repeat(distance, valid.sum()))
+
+		rows = numpy.concatenate(rows)
+		order = numpy.argsort(rows, kind='mergesort')
+
+		self.indices = numpy.concatenate(neighbours)[order]
+		self.distances = numpy.concatenate(distances)[order]
+
+		self.degree = numpy.bincount(rows, minlength=len(self.cells))
+		self.indptr = numpy.zeros(len(self.cells) + 1, dtype=numpy.intp)
+		numpy.cumsum(self.degree, out=self.indptr[1:])
+
+		# Only rows with at least one neighbour take part in the reduction
+		self._starts = self.indptr[:-1][self.degree > 0]
+		self._nonempty = self.cells[self.degree > 0]
+
+		# Python lists of the index, for searches which visit one cell at a time
+		self._lists = None
+		self._neighbours = {}
+
+		# Decay times the position along each axis, by decay
+		self._ramps = {}
+		self._line_ramps = (None, None)
+
+		# Connected component of each cell, and the cells reachable from a set of components
+		self._components = None
+		self._reach = {}
+
+	@classmethod
+	def from_callback(cls, width, height, is_blocked):
 		"""
-			Divides each element with the given scalar
+			Creates the neighbour index using a callback, which returns True
+			for each position (as tuple) which is blocked.
 		"""
 
-		new_map = self.__class__(self.decay, self.momentum, self.width, self.height, self.is_blocked)
+		walkable = numpy.ones((width, height), dtype=bool)
 
-		for key in self.influence:
-			new_map.influence[key] = self.influence[key] / scalar
+		for x in xrange(width):
+			for y in xrange(height):
+				if is_blocked((x, y)):
+					walkable[x, y] = False
 
-		return new_map
+		return cls(width, height, walkable)
+
+	def spread(self, sources, decay, out=None, pool=None):
+		"""
+			Spreads the given sources over the whole grid at once. `sources`
+			is an array of shape (width, height), which is zero except at
+			the sources. Each cell gets the maximum over all sources of the
+			source value times ``exp(-decay * (|dx| + |dy|))``, which is
+			the converged max-rule field on an open grid.
+
+			The kernel is separable, so this takes a forward and backward
+			cumulative maximum along each axis, on the logarithm of the
+			values. Cells which are not connected to any source are set to
+			zero. Within a connected region, blocked cells do not stop the
+			spread, distances are measured as if the region was open.
+
+			The result is written into `out`, which may be `sources`
+			itself. Temporary arrays are taken from `pool`.
+		"""
+
+		if out is None:
+			out = numpy.empty(sources.shape)
+
+		if pool is None:
+			pool = BufferPool()
+
+		if decay not in self._ramps:
+			self._ramps[decay] = (decay * numpy.arange(self.width)[:, numpy.newaxis], decay * numpy.arange(self.height))
+
+		ramp_x, ramp_y = self._ramps[decay]
+
+		found = pool.acquire(sources.shape, bool)
+		numpy.greater(sources, 0.0, out=found)
+		reach = self.get_reach(numpy.flatnonzero(found))
+
+		field = pool.acquire(sources.shape)
+		work = pool.acquire(sources.shape)
+
+		numpy.maximum(sources, 0.0, out=field)
+
+		with numpy.errstate(divide='ignore'):
+			numpy.log(field, out=field)
+
+		_max_decay_scan(field, work, ramp_x, 0)
+		_max_decay_scan(field, work, ramp_y, 1)
+
+		numpy.exp(field, out=out)
+		out *= reach
+
+		pool.release(found, field, work)
+
+		return out
+
+	def get_components(self):
+		"""
+			Returns the label of the connected component of each cell, as
+			array indexed by cell index. Blocked cells are labelled -1.
+		"""
+
+		if self._components is None:
+			indptr, indices, distances, rows = self.get_lists()
+
+			labels = [-1] * (self.width * self.height)
+			label = 0
+			for cell in self.cells.tolist():
+				if labels[cell] >= 0:
+					continue
+
+				labels[cell] = label
+				stack = [cell]
+				while stack:
+					row = rows[stack.pop()]
+
+					for edge in xrange(indptr[row], indptr[row+1]):
+						neighbour = indices[edge]
+
+						if labels[neighbour] < 0:
+							labels[neighbour] = label
+							stack.append(neighbour)
+
+				label += 1
+
+			self._components = numpy.array(labels)
+
+		return self._components
+
+	def get_reach(self, cells):
+		"""
+			Returns a boolean array of shape (width, height), True for the
+			walkable cells connected to any of the given cells. The result
+			is cached by the set of components.
+		"""
+
+		components = self.get_components()
+		labels = frozenset(components[cells].tolist()) - frozenset([-1])
+
+		if labels not in self._reach:
+			self._reach[labels] = numpy.in1d(components, list(labels)).reshape((self.width, self.height))
+
+		return self._reach[labels]
+
+	def sweep(self, values, decay, tolerance=1e-4, max_sweeps=16):
+		"""
+			Propagates `values`, an array of shape (width, height), in place
+			until it has converged to the maximum of all values decayed by
+			their shortest path distance, like :meth:`steady_state`.
+
+			Instead of reading only old values, the grid is swept line by
+			line. Each line takes the decayed values of the line before it,
+			which was just computed, and of the line after it. Then it is
+			scanned forward and backward with a cumulative maximum, so
+			influence moves along the whole line at once, up to the next
+			wall. The direction alternates between increasing and
+			decreasing x and y, so influence crosses the whole map in a
+			few sweeps. Sweeping stops when no value changed more than
+			`tolerance`, or after `max_sweeps` sweeps.
+
+			Assumes the four neighbours at distance 1 of :attr:`OFFSETS`.
+			Returns the number of sweeps and the largest change in the
+			last sweep.
+		"""
+
+		ramps = self._get_line_ramps(decay)
+		blocked = ~self.walkable
+
+		# The sweep works on the logarithm of the values, decay becomes a subtraction
+		numpy.maximum(values, 0.0, out=values)
+		with numpy.errstate(divide='ignore'):
+			numpy.log(values, out=values)
+
+		values[blocked] = -numpy.inf
+
+		sweeps = 0
+		residual = 0.0
+		while sweeps < max_sweeps:
+			direction = sweeps % 4
+
+			# Sweep along x with the first two directions, along y with the others
+			grid = values if direction < 2 else values.T
+			walls = blocked if direction < 2 else blocked.T
+			ramp = ramps[direction >= 2]
+			lines = xrange(len(grid) - 1, -1, -1) if direction % 2 else xrange(len(grid))
+
+			work = numpy.empty(grid.shape[1])
+
+			residual = 0.0
+			for i in lines:
+				line = grid[i]
+				old = numpy.exp(line)
+
+				if i > 0:
+					numpy.maximum(line, grid[i-1] - decay, out=line)
+
+				if i < len(grid) - 1:
+					numpy.maximum(line, grid[i+1] - decay, out=line)
+
+				line[walls[i]] = -numpy.inf
+				_max_decay_scan(line, work, ramp[i], 0)
+				line[walls[i]] = -numpy.inf
+
+				if len(line):
+					residual = max(residual, numpy.abs(numpy.exp(line) - old).max())
+
+			sweeps += 1
+
+			if residual <= tolerance:
+				break
+
+		numpy.exp(values, out=values)
+
+		return sweeps, residual
+
+	def _get_line_ramps(self, decay):
+		"""
+			Returns the ramps used by :meth:`sweep` for lines along y and
+			along x. Besides the decay times the position along the line,
+			each wall adds a penalty which is larger than any difference
+			of logarithms, so the scans don't cross walls.
+		"""
+
+		if self._line_ramps[0] != decay:
+			blocked = ~self.walkable
+			penalty = 2000.0 + decay * max(self.width, self.height)
+
+			along_y = decay * numpy.arange(self.height) + penalty * numpy.cumsum(blocked, axis=1)
+			along_x = decay * numpy.arange(self.width)[:, numpy.newaxis] + penalty * numpy.cumsum(blocked, axis=0)
+
+			self._line_ramps = (decay, (along_y, along_x.T))
+
+		return self._line_ramps[1]
+
+	def downsample(self, factor):
+		"""
+			Returns a coarser topology, in which each cell covers a block of
+			`factor` x `factor` cells of this one. A coarse cell is walkable
+			if its walkable cells are connected within the block, so it can
+			be crossed in any direction. Two coarse cells are neighbours
+			only if a walkable cell next to their shared border can be
+			entered from a walkable cell on the other side.
+		"""
+
+		width = -(-self.width // factor)
+		height = -(-self.height // factor)
+
+		walkable = numpy.zeros((width * factor, height * factor), dtype=bool)
+		walkable[:self.width, :self.height] = self.walkable
+
+		# Links between cells next to each other in the same block
+		inner_x = (numpy.arange(width * factor) % factor != 0)[1:, numpy.newaxis]
+		inner_y = (numpy.arange(height * factor) % factor != 0)[1:]
+		link_x = walkable[1:] & walkable[:-1] & inner_x
+		link_y = walkable[:, 1:] & walkable[:, :-1] & inner_y
+
+		# Each walkable cell takes the lowest label of the cells it is connected to in its block
+		size = walkable.size
+		labels = numpy.where(walkable, numpy.arange(size).reshape(walkable.shape), size)
+		while True:
+			new = labels.copy()
+			numpy.minimum(new[1:], numpy.where(link_x, labels[:-1], size), out=new[1:])
+			numpy.minimum(new[:-1], numpy.where(link_x, labels[1:], size), out=new[:-1])
+			numpy.minimum(new[:, 1:], numpy.where(link_y, labels[:, :-1], size), out=new[:, 1:])
+			numpy.minimum(new[:, :-1], numpy.where(link_y, labels[:, 1:], size), out=new[:, :-1])
+
+			if (new == labels).all():
+				break
+
+			labels = new
+
+		lowest = labels.reshape((width, factor, height, factor)).min(axis=3).min(axis=1)
+		highest = numpy.where(walkable, labels, -1).reshape((width, factor, height, factor)).max(axis=3).max(axis=1)
+		connected = (lowest < size) & (lowest == highest)
+
+		# Borders between blocks which can be crossed
+		cross_x = (walkable[factor-1:-1:factor] & walkable[factor::factor]).reshape((width - 1, height, factor)).any(axis=2)
+		cross_y = (walkable[:, factor-1:-1:factor] & walkable[:, factor::factor]).reshape((width, factor, height - 1)).any(axis=1)
+
+		passable = numpy.zeros((len(self.OFFSETS), width, height), dtype=bool)
+		for k, (dx, dy, distance) in enumerate(self.OFFSETS):
+			if (dx, dy) == (1, 0):
+				passable[k, :-1] = cross_x
+			elif (dx, dy) == (-1, 0):
+				passable[k, 1:] = cross_x
+			elif (dx, dy) == (0, 1):
+				passable[k, :, :-1] = cross_y
+			elif (dx, dy) == (0, -1):
+				passable[k, :, 1:] = cross_y
+
+		return GridTopology(width, height, connected, passable)
+
+	def is_blocked(self, position):
+		x, y = int(position[0]), int(position[1])
+
+		if x < 0 or x >= self.width or y < 0 or y >= self.height:
+			return True
+
+		return not self.walkable[x, y]
+
+	def neighbours(self, position):
+		"""
+			Returns a list of (position, distance) tuples with the neighbours
+			of the given position.
+		"""
+
+		x, y = int(position[0]), int(position[1])
+		if (x, y) in self._neighbours:
+			return self._neighbours[x, y]
+
+		neighbours = []
+		if 0 <= x < self.width and 0 <= y < self.height and self.walkable[x, y]:
+			row = self.rows[x * self.height + y]
+			start, end = self.indptr[row], self.indptr[row+1]
+
+			neighbours = [(divmod(int(index), self.height), float(distance))
+				for index, distance in zip(self.indices[start:end], self.distances[start:end])]
+
+		# The lists are kept, for maps which look up neighbours one cell at a time
+		self._neighbours[x, y] = neighbours
+
+		return neighbours
+
+	def weights(self, decay):
+		"""
+			Returns the decay factor for each edge
+		"""
+
+		return numpy.exp(-self.distances * decay)
+
+	def get_lists(self):
+		"""
+			Returns the index as Python lists, for searches which visit
+			one cell at a time: (indptr, indices, distances, rows).
+		"""
+
+		if self._lists is None:
+			self._lists = (self.indptr.tolist(), self.indices.tolist(), self.distances.tolist(), self.rows.tolist())
+
+		return self._lists
+
+	def steady_state(self, values, decay, threshold=1e-4):
+		"""
+			Multi-source Dijkstra search over the index, see
+			:meth:`BaseInfluenceMap.steady_state`. `values` is a flat array
+			indexed by cell index, and is not modified. Returns the new
+			values.
+		"""
+
+		indptr, indices, distances, rows = self.get_lists()
+
+		result = values.copy()
+		best = result.tolist()
+
+		queue = [(-best[cell], cell) for cell in self.cells[result[self.cells] > threshold].tolist()]
+		heapq.heapify(queue)
+
+		while queue:
+			value, cell = heapq.heappop(queue)
+			value = -value
+
+			# Skip outdated entries
+			if value < best[cell]:
+				continue
+
+			row = rows[cell]
+			for edge in xrange(indptr[row], indptr[row+1]):
+				neighbour = indices[edge]
+				influence = value * math.exp(-distances[edge] * decay)
+
+				if influence > threshold and influence > best[neighbour]:
+					best[neighbour] = influence
+					heapq.heappush(queue, (-influence, neighbour))
+
+		result[self.cells] = numpy.take(best, self.cells)
+
+		return result
+
+	def get_edges(self, rows):
+		"""
+			Returns the edge numbers of all neighbours of the given rows,
+			together with the offset of the first edge of each row.
+		"""
+
+		counts = self.degree[rows]
+		offsets = numpy.cumsum(counts) - counts
+
+		edges = numpy.arange(counts.sum()) + numpy.repeat(self.indptr[rows] - offsets, counts)
+
+		return edges, offsets
+
+	def expand(self, cells):
+		"""
+			Returns the walkable cells among the given cells and their
+			neighbours, as sorted array of cell indices.
+		"""
+
+		rows = self.rows[cells]
+		rows = rows[rows >= 0]
+
+		edges, offsets = self.get_edges(rows)
+
+		return numpy.union1d(self.cells[rows], self.indices[edges])
+
+	def max_neighbours(self, values, weights, rows=None):
+		"""
+			For each walkable cell, returns the maximum of the weighted
+			values of its neighbours. The last axis of `values` is indexed
+			by cell index, which makes it possible to process multiple
+			layers at once. The last axis of the result is ordered like
+			:attr:`cells`, or like `rows` if only a subset of the rows
+			should be computed.
+		"""
+
+		if rows is None:
+			max_infl = numpy.zeros(values.shape[:-1] + (len(self.cells),))
+
+			if len(self.indices):
+				max_infl[..., self.degree > 0] = numpy.maximum.reduceat(values[..., self.indices] * weights,
+					self._starts, axis=-1)
+
+			return max_infl
+
+		max_infl = numpy.zeros(values.shape[:-1] + (len(rows),))
+		edges, offsets = self.get_edges(rows)
+
+		if len(edges):
+			nonempty = self.degree[rows] > 0
+			max_infl[..., nonempty] = numpy.maximum.reduceat(values[..., self.indices[edges]] * weights[..., edges],
+				offsets[nonempty], axis=-1)
+
+		return max_infl
+
+	def max_neighbours_into(self, values, weights, out, pool):
+		"""
+			Same as :meth:`max_neighbours` for all cells, but the result is
+			written into `out`, which is indexed by cell index like
+			`values`. Temporary arrays are taken from `pool`, so no new
+			arrays are allocated once the pool is filled.
+		"""
+
+		out.fill(0.0)
+
+		if not len(self.indices):
+			return out
+
+		shape = values.shape[:-1]
+		gathered = pool.acquire(shape + (len(self.indices),))
+		reduced = pool.acquire(shape + (len(self._starts),))
+
+		numpy.take(values, self.indices, axis=-1, out=gathered, mode='clip')
+		gathered *= weights
+		numpy.maximum.reduceat(gathered, self._starts, axis=-1, out=reduced)
+		out[..., self._nonempty] = reduced
+
+		pool.release(gathered, reduced)
+
+		return out
+
+def _max_decay_scan(values, work, ramp, axis):
+	"""
+		Replaces `values`, the logarithm of a field, in place by the
+		maximum over its line along `axis` of all values decayed by their
+		distance. `ramp` holds the decay times the position along the
+		axis, and `work` is a temporary array of the same shape.
+	"""
+
+	numpy.subtract(values, ramp, out=work)
+
+	# Forward, the maximum of values[j] - decay * (i - j) for j <= i
+	values += ramp
+	numpy.maximum.accumulate(values, axis=axis, out=values)
+	values -= ramp
+
+	# Backward, the same for j >= i
+	backward = work[::-1] if axis == 0 else work[:, ::-1]
+	numpy.maximum.accumulate(backward, axis=axis, out=backward)
+	work += ramp
+
+	numpy.maximum(values, work, out=values)
+
+def _propagate(topology, values, dirty, weights, momentum, incremental, threshold, pool):
+	"""
+		Performs a single update in place on `values`, of which the last
+		axis is indexed by cell index, and marks the cells which changed
+		more than `threshold` in `dirty`. See
+		:meth:`DenseGridInfluenceMap.update_map` for the update rule.
+	"""
+
+	if incremental:
+		changed = numpy.flatnonzero(dirty.reshape((-1, values.shape[-1])).any(axis=0))
+		cells = topology.expand(changed)
+		max_infl = topology.max_neighbours(values, weights, topology.rows[cells])
+
+		old = values[..., cells]
+		new = lerp(old, max_infl, momentum)
+
+		values[..., cells] = new
+		values[..., changed[topology.rows[changed] < 0]] = 0.0
+
+		dirty.fill(False)
+		dirty[..., cells] = numpy.abs(new - old) > threshold
+	else:
+		old = pool.acquire(values.shape)
+		max_infl = pool.acquire(values.shape)
+
+		numpy.copyto(old, values)
+		topology.max_neighbours_into(values, weights, max_infl, pool)
+
+		# Interpolate in place, lerp(old, max_infl, momentum)
+		values *= 1 - momentum
+		max_infl *= momentum
+		values += max_infl
+		values[..., topology.blocked] = 0.0
+
+		numpy.subtract(values, old, out=old)
+		numpy.abs(old, out=old)
+		numpy.greater(old, threshold, out=dirty)
+
+		pool.release(old, max_infl)
+
+class DenseGridInfluenceMap(BaseInfluenceMap):
+	"""
+		Influence map for grid based worlds, backed by a dense NumPy
+		array instead of a dictionary. Propagation gathers the values of
+		all neighbours at once using a precomputed :class:`GridTopology`,
+		so no bounds or blocked checks are done per update.
+	"""
+
+	def __init__(self, decay=0.2, momentum=0.5, width=0, height=0, is_blocked=lambda pos: False, topology=None,
+			pool=None, propagation='max'):
+		BaseInfluenceMap.__init__(self, decay, momentum)
+
+		# Build the neighbour index once, maps created from this one share it
+		if topology is None:
+			topology = GridTopology.from_callback(width, height, is_blocked)
+
+		self._setup(topology, is_blocked, pool, propagation)
+
+		self.influence = numpy.zeros((self.width, self.height))
+
+		# Cells changed since their last propagation, see update_map
+		self._dirty = numpy.zeros(self.width * self.height, dtype=bool)
+
+	def _setup(self, topology, is_blocked, pool, propagation):
+		"""
+			Initializes everything except the values and the dirty mask,
+			which are stored elsewhere by :class:`InfluenceLayer`.
+		"""
+
+		self.topology = topology
+		self.width = topology.width
+		self.height = topology.height
+
+		self.is_blocked = is_blocked
+		self.walkable = topology.walkable
+
+		# Incremented on each change, used by views to invalidate their cache
+		self.version = 0
+
+		# Temporary arrays used during updates
+		self.pool = pool if pool is not None else BufferPool()
+
+		# Either 'max', 'convolution' or 'sweep', see update_map
+		self.propagation = propagation
+		self._sources = {}
+
+		# Limit and result of the last sweep based update
+		self.max_sweeps = 16
+		self.convergence = (0, 0.0)
+
+		self._weights = (None, None)
+
+	def set_influence(self, position, influence):
+		x, y = int(position[0]), int(position[1])
+
+		self.influence[x, y] = influence
+		self._dirty[x * self.height + y] = True
+		self._sources[x * self.height + y] = influence
+		self.version += 1
+
+	def get_influence(self, position):
+		x, y = int(position[0]), int(position[1])
+
+		if x < 0 or x >= self.width or y < 0 or y >= self.height:
+			return 0.0
+
+		return float(self.influence[x, y])
+
+	def get_neighbours(self, position):
+		return self.topology.neighbours(position)
+
+	def get_weights(self):
+		"""
+			Returns the decay factor of each edge in the topology, cached
+			as long as the decay does not change.
+		"""
+
+		if self._weights[0] != self.decay:
+			self._weights = (self.decay, self.topology.weights(self.decay))
+
+		return self._weights[1]
+
+	def update_map(self, num_times=1, incremental=False, threshold=1e-4):
+		"""
+			Performs `num_times` iterations over the grid. Each cell takes
+			the maximum of its decayed neighbours, and is interpolated with
+			its old value. Blocked cells do not receive or spread any
+			influence.
+
+			When `incremental` is True, only the cells changed by
+			:meth:`set_influence` or by the previous update, and their
+			neighbours, are recomputed. Changes smaller than `threshold`
+			are not propagated any further, so the cost of an update
+			depends on the activity on the map instead of its size. A
+			full update recomputes every cell, and can be used to verify
+			the incremental results.
+
+			When :attr:`propagation` is 'convolution', the sources set
+			since the previous update are spread over the whole grid at
+			once with :meth:`GridTopology.spread`, and each cell is
+			interpolated towards the result. This reaches the full spread
+			radius in a fixed number of array operations. Only regions
+			connected to a source receive influence, but within a region
+			the distance is measured through walls, so it is best suited
+			for layers with a wide radius.
+
+			When :attr:`propagation` is 'sweep', the sources are spread
+			with :meth:`GridTopology.sweep` instead, which does respect
+			walls. The number of sweeps and the residual are stored in
+			:attr:`convergence`.
+		"""
+
+		if self.propagation != 'max':
+			self._spread(num_times, threshold)
+		else:
+			weights = self.get_weights()
+
+			i = 0
+			while i < num_times:
+				_propagate(self.topology, self.influence.ravel(), self._dirty, weights, self.momentum,
+					incremental, threshold, self.pool)
+
+				i += 1
+
+		self._sources.clear()
+		self.version += 1
+
+	def _spread(self, num_times, threshold):
+		"""
+			Convolution or sweep based update, see :meth:`update_map`
+		"""
+
+		field = self.pool.acquire((self.width, self.height))
+		field.fill(0.0)
+		field.ravel()[self._sources.keys()] = self._sources.values()
+
+		if self.propagation == 'convolution':
+			self.topology.spread(field, self.decay, out=field, pool=self.pool)
+		else:
+			self.convergence = self.topology.sweep(field, self.decay, threshold, self.max_sweeps)
+
+		values = self.influence
+		old = self.pool.acquire(values.shape)
+		numpy.copyto(old, values)
+
+		# Interpolating `num_times` towards the same field, in place
+		values -= field
+		values *= (1 - self.momentum) ** num_times
+		values += field
+
+		numpy.subtract(values, old, out=old)
+		numpy.abs(old, out=old)
+		numpy.greater(old.ravel(), threshold, out=self._dirty)
+
+		self.pool.release(field, old)
+
+	def converge(self, tolerance=1e-4, max_sweeps=16):
+		"""
+			Propagates the current values in place until they have
+			converged, using :meth:`GridTopology.sweep`. Returns the number
+			of sweeps and the residual, so callers can check whether the
+			map has converged within `max_sweeps`.
+		"""
+
+		self.convergence = self.topology.sweep(self.influence, self.decay, tolerance, max_sweeps)
+		self._changed()
+
+		return self.convergence
+
+	def steady_state(self, threshold=1e-4):
+		values = self.influence.ravel()
+		result = self.topology.steady_state(values, self.decay, threshold)
+
+		numpy.logical_or(self._dirty, result != values, out=self._dirty)
+		values[:] = result
+
+		self.version += 1
+
+	def get_values(self):
+		"""
+			Returns the values of all cells, as array of shape (width, height)
+		"""
+
+		return self.influence
+
+	def get_items(self):
+		return _grid_items(self.influence)
+
+	def like(self):
+		"""
+			Returns a new map for the same level with all values set to
+			zero. The topology and buffer pool are shared.
+		"""
+
+		return DenseGridInfluenceMap(self.decay, self.momentum, is_blocked=self.is_blocked, topology=self.topology,
+			pool=self.pool, propagation=self.propagation)
+
+	def copy(self):
+		"""
+			Returns a copy of this map, only the values are copied.
+		"""
+
+		out = self.like()
+		numpy.copyto(out.influence, self.influence)
+		out._changed()
+
+		return out
+
+	def _changed(self):
+		"""
+			Marks all values as changed, after they have been overwritten
+		"""
+
+		self._dirty.fill(True)
+		self.version += 1
+
+	def _values(self, other):
+		"""
+			Returns the values of another influence map as an array
+			with the same shape as this map.
+		"""
+
+		return other.get_values()
+
+	def add(self, other, out=None):
+		if out is None:
+			out = self.like()
+
+		numpy.add(self.influence, self._values(other), out=out.influence)
+		out._changed()
+
+		return out
+
+	def subtract(self, other, out=None):
+		if out is None:
+			out = self.like()
+
+		numpy.subtract(self.influence, self._values(other), out=out.influence)
+		out._changed()
+
+		return out
+
+	def multiply(self, scalar, out=None):
+		if out is None:
+			out = self.like()
+
+		numpy.multiply(self.influence, scalar, out=out.influence)
+		out._changed()
+
+		return out
+
+	def divide(self, scalar, out=None):
+		if out is None:
+			out = self.like()
+
+		numpy.true_divide(self.influence, scalar, out=out.influence)
+		out._changed()
+
+		return out
+
+class HierarchicalInfluenceMap(BaseInfluenceMap):
+	"""
+		Coarse-to-fine influence map for large levels. Next to the full
+		resolution map, it keeps a downsampled map in which each cell
+		covers a block of `factor` x `factor` cells. Influence spreads
+		over the coarse map `factor` cells per update at a fraction of
+		the cost, so distant sources become noticeable much sooner.
+
+		Look-ups take the maximum of the fine value and the coarse
+		value, where the coarse value is damped by one coarse step. This
+		way the blocky coarse map provides the long range influence,
+		but doesn't override the local detail around a source. The fine
+		map only needs to be accurate near the sources, so changes
+		smaller than `detail` are not propagated on it.
+	"""
+
+	def __init__(self, decay=0.2, momentum=0.5, width=0, height=0, is_blocked=lambda pos: False, topology=None,
+			factor=4, pool=None, detail=0.01):
+		BaseInfluenceMap.__init__(self, decay, momentum)
+
+		self.fine = DenseGridInfluenceMap(decay, momentum, width, height, is_blocked, topology, pool)
+		self.coarse = DenseGridInfluenceMap(decay * factor, momentum, topology=self.fine.topology.downsample(factor),
+			pool=self.fine.pool)
+
+		self.factor = factor
+		self.detail = detail
+		self.width = self.fine.width
+		self.height = self.fine.height
+
+		del self.influence
+
+	@property
+	def version(self):
+		return self.fine.version, self.coarse.version
+
+	def set_influence(self, position, influence):
+		self.fine.set_influence(position, influence)
+		self.coarse.set_influence((int(position[0]) // self.factor, int(position[1]) // self.factor), influence)
+
+	def get_influence(self, position):
+		x, y = int(position[0]), int(position[1])
+
+		if self.fine.topology.is_blocked((x, y)):
+			return 0.0
+
+		coarse = self.coarse.get_influence((x // self.factor, y // self.factor)) * math.exp(-self.decay * self.factor)
+
+		return max(self.fine.get_influence(position), coarse)
+
+	def get_neighbours(self, position):
+		return self.fine.get_neighbours(position)
+
+	def get_values(self):
+		"""
+			Returns the blended values of all cells, as array of shape
+			(width, height).
+		"""
+
+		coarse = self.coarse.influence.repeat(self.factor, axis=0).repeat(self.factor, axis=1)
+
+		values = numpy.maximum(self.fine.influence, coarse[:self.width, :self.height] * math.exp(-self.decay * self.factor))
+		values *= self.fine.walkable
+
+		return values
+
+	def get_items(self):
+		return _grid_items(self.get_values())
+
+	def update_map(self, num_times=1, incremental=False, threshold=1e-4):
+		"""
+			Updates both the fine and coarse map, see
+			:meth:`DenseGridInfluenceMap.update_map`. The fine map is
+			always updated incrementally, with a threshold of at least
+			`detail`, so only the region around recent changes is
+			recomputed.
+		"""
+
+		self.fine.decay = self.decay
+		self.fine.momentum = self.momentum
+		self.coarse.decay = self.decay * self.factor
+		self.coarse.momentum = self.momentum
+
+		self.fine.update_map(num_times, True, max(threshold, self.detail))
+		self.coarse.update_map(num_times, incremental, threshold)
+
+	def steady_state(self, threshold=1e-4):
+		self.fine.steady_state(threshold)
+		self.coarse.steady_state(threshold)
+
+	def like(self):
+		"""
+			Returns a new map for the same level with all values set to
+			zero. Both topologies are shared.
+		"""
+
+		new_map = self.__class__.__new__(self.__class__)
+		new_map.__dict__.update(self.__dict__)
+		new_map.fine = self.fine.like()
+		new_map.coarse = self.coarse.like()
+
+		return new_map
+
+	def copy(self):
+		"""
+			Returns a copy of this map, only the values are copied.
+		"""
+
+		out = self.like()
+		numpy.copyto(out.fine.influence, self.fine.influence)
+		numpy.copyto(out.coarse.influence, self.coarse.influence)
+		out._changed()
+
+		return out
+
+	def _changed(self):
+		self.fine._changed()
+		self.coarse._changed()
+
+	def _levels(self, other):
+		"""
+			Returns the values of another influence map for the fine and
+			the coarse map. Other types of maps are downsampled by taking
+			the maximum of each block.
+		"""
+
+		if isinstance(other, HierarchicalInfluenceMap) and other.factor == self.factor:
+			return other.fine.influence, other.coarse.influence
+
+		values = self.fine._values(other)
+
+		blocks = numpy.zeros((self.coarse.width * self.factor, self.coarse.height * self.factor))
+		blocks[:self.width, :self.height] = values
+		blocks = blocks.reshape((self.coarse.width, self.factor, self.coarse.height, self.factor)).max(axis=3).max(axis=1)
+
+		return values, blocks
+
+	def _apply(self, operation, fine, coarse, out):
+		"""
+			Applies a NumPy operation to the fine and the coarse map
+			separately, with the given operands. The result is stored in
+			`out`, which may be this map itself.
+		"""
+
+		if out is None:
+			out = self.like()
+
+		operation(self.fine.influence, fine, out=out.fine.influence)
+		operation(self.coarse.influence, coarse, out=out.coarse.influence)
+		out._changed()
+
+		return out
+
+	def _blended(self):
+		blended = self.fine.like()
+		blended.influence = self.get_values()
+
+		return blended
+
+	# Arithmetic works on the fine and coarse map separately, unless the result is stored in another type of map
+	def add(self, other, out=None):
+		if out is not None and not isinstance(out, HierarchicalInfluenceMap):
+			return self._blended().add(other, out)
+
+		return self._apply(numpy.add, *self._levels(other), out=out)
+
+	def subtract(self, other, out=None):
+		if out is not None and not isinstance(out, HierarchicalInfluenceMap):
+			return self._blended().subtract(other, out)
+
+		return self._apply(numpy.subtract, *self._levels(other), out=out)
+
+	def multiply(self, scalar, out=None):
+		if out is not None and not isinstance(out, HierarchicalInfluenceMap):
+			return self._blended().multiply(scalar, out)
+
+		return self._apply(numpy.multiply, scalar, scalar, out)
+
+	def divide(self, scalar, out=None):
+		if out is not None and not isinstance(out, HierarchicalInfluenceMap):
+			return self._blended().divide(scalar, out)
+
+		return self._apply(numpy.true_divide, scalar, scalar, out)
+
+class SparseInfluenceMap(BaseInfluenceMap):
+	"""
+		Influence map for grid based worlds, which only stores the cells
+		with an influence above `epsilon`. Updates only visit the stored
+		cells and their neighbours, so maps with a few concentrated
+		sources are cheap to update, regardless of the size of the level.
+	"""
+
+	def __init__(self, decay=0.2, momentum=0.5, width=0, height=0, is_blocked=lambda pos: False, topology=None,
+			epsilon=1e-3):
+		BaseInfluenceMap.__init__(self, decay, momentum)
+
+		if topology is None:
+			topology = GridTopology.from_callback(width, height, is_blocked)
+
+		self.topology = topology
+		self.width = topology.width
+		self.height = topology.height
+
+		self.is_blocked = is_blocked
+		self.epsilon = epsilon
+
+		# Plain dictionary, reading a cell should not insert it
+		self.influence = {}
+		self.version = 0
+
+		# Cells changed since their last propagation, see update_map
+		self._dirty = set()
+
+	def set_influence(self, position, influence):
+		position = (int(position[0]), int(position[1]))
+
+		if influence > self.epsilon:
+			self.influence[position] = influence
+		else:
+			self.influence.pop(position, None)
+
+		self._dirty.add(position)
+		self.version += 1
+
+	def get_influence(self, position):
+		return self.influence.get((int(position[0]), int(position[1])), 0.0)
+
+	def get_neighbours(self, position):
+		return self.topology.neighbours(position)
+
+	def update_map(self, num_times=1, incremental=False, threshold=1e-4):
+		"""
+			Performs `num_times` iterations with the same rule as
+			:meth:`BaseInfluenceMap.update_map`, but only over the stored
+			cells and their neighbours. Cells which drop below `epsilon`
+			are removed.
+
+			When `incremental` is True, only the cells changed by
+			:meth:`set_influence` or by more than `threshold` in the
+			previous update, and their neighbours, are recomputed, like
+			:meth:`DenseGridInfluenceMap.update_map`.
+		"""
+
+		factors = {}
+
+		i = 0
+		while i < num_times:
+			active = self._dirty if incremental else self.influence
+
+			frontier = set(active)
+			for position in active:
+				frontier.update(neighbour for neighbour, distance in self.get_neighbours(position))
+
+			# Cells outside the frontier keep their value in incremental mode
+			new_influence = dict(self.influence) if incremental else {}
+			dirty = set()
+
+			for position in frontier:
+				max_infl = 0.0
+
+				for neighbour, distance in self.get_neighbours(position):
+					if neighbour in self.influence:
+						if distance not in factors:
+							factors[distance] = math.exp(-distance * self.decay)
+
+						max_infl = max(self.influence[neighbour] * factors[distance], max_infl)
+
+				old = self.influence.get(position, 0.0)
+				influence = lerp(old, max_infl, self.momentum)
+
+				if abs(influence - old) > threshold:
+					dirty.add(position)
+
+				if influence > self.epsilon:
+					new_influence[position] = influence
+				else:
+					new_influence.pop(position, None)
+
+			self.influence = new_influence
+			self._dirty = dirty
+
+			i += 1
+
+		self.version += 1
+
+	def steady_state(self, threshold=None):
+		old = dict(self.influence)
+
+		BaseInfluenceMap.steady_state(self, self.epsilon if threshold is None else threshold)
+
+		self._dirty.update(position for position, value in self.influence.iteritems() if old.get(position) != value)
+		self.version += 1
+
+	def _changed(self):
+		self._dirty.update(self.influence)
+		self.version += 1
+
+	def like(self):
+		"""
+			Returns a new, empty map on the same topology
+		"""
+
+		return self.__class__(self.decay, self.momentum, is_blocked=self.is_blocked, topology=self.topology,
+			epsilon=self.epsilon)
+
+	def copy(self):
+		"""
+			Returns a copy of this map, only the values are copied.
+		"""
+
+		new_map = self.like()
+		new_map.influence.update(self.influence)
+		new_map._changed()
+
+		return new_map
+
+class InfluenceLayer(DenseGridInfluenceMap):
+	"""
+		A single layer of an :class:`InfluenceStack`. It behaves like a
+		:class:`DenseGridInfluenceMap`, but its values live in a row of
+		the buffer of the stack.
+	"""
+
+	def __init__(self, stack, index, decay=0.2, momentum=0.5):
+		self.stack = stack
+		self.index = index
+
+		# The values are stored in the stack, so BaseInfluenceMap.__init__ is skipped
+		self.decay = decay
+		self.momentum = momentum
+
+		self._setup(stack.topology, stack.topology.is_blocked, stack.pool, 'max')
+
+	@property
+	def influence(self):
+		return self.stack.values[self.index].reshape((self.width, self.height))
+
+	@influence.setter
+	def influence(self, influence):
+		self.stack.values[self.index] = influence.ravel()
+
+	@property
+	def _dirty(self):
+		return self.stack.dirty[self.index]
+
+	@_dirty.setter
+	def _dirty(self, dirty):
+		self.stack.dirty[self.index] = dirty
+
+class InfluenceStack(object):
+	"""
+		Multiple influence maps on the same topology, stored in a single
+		(layers x cells) buffer. All layers are propagated in a single
+		pass over the neighbour index, each with its own decay and
+		momentum.
+	"""
+
+	def __init__(self, topology, parameters, pool=None):
+		"""
+			Initializes the stack
+
+			:Arguments:
+				* topology (:class:`GridTopology`): The neighbour index shared by all layers
+				* parameters: A list of (decay, momentum) tuples, one for each layer
+				* pool (:class:`BufferPool`): Pool for temporary arrays, a new one is created if not given
+		"""
+
+		self.topology = topology
+		self.pool = pool if pool is not None else BufferPool()
+		self.values = numpy.zeros((len(parameters), topology.width * topology.height))
+		self.dirty = numpy.zeros(self.values.shape, dtype=bool)
+
+		self.layers = [InfluenceLayer(self, i, decay, momentum) for i, (decay, momentum) in enumerate(parameters)]
+
+		self._weights = (None, None)
+
+	def __len__(self):
+		return len(self.layers)
+
+	def __getitem__(self, index):
+		return self.layers[index]
+
+	def get_weights(self, layers=None):
+		"""
+			Returns the decay factor of each edge for the given layers, or
+			all layers, as a (layers x edges) array.
+		"""
+
+		if layers is None:
+			layers = self.layers
+
+		decays = tuple(layer.decay for layer in layers)
+
+		if self._weights[0] != decays:
+			self._weights = (decays, numpy.exp(-numpy.outer(decays, self.topology.distances)))
+
+		return self._weights[1]
+
+	def update_map(self, num_times=1, incremental=False, threshold=1e-4):
+		"""
+			Performs `num_times` iterations over all layers at once, with the
+			same rules as :meth:`DenseGridInfluenceMap.update_map`. In
+			incremental mode, the region which is recomputed is the union
+			of the changed cells of all layers.
+
+			Layers using convolution or sweeps are left out of the fused
+			pass, and are updated on their own.
+		"""
+
+		fused = [layer for layer in self.layers if layer.propagation == 'max']
+
+		if fused:
+			weights = self.get_weights(fused)
+			momentum = numpy.array([[layer.momentum] for layer in fused])
+
+			# The fused layers are gathered into pooled buffers, unless all layers take part
+			if len(fused) == len(self.layers):
+				values, dirty = self.values, self.dirty
+			else:
+				rows = [layer.index for layer in fused]
+
+				values = self.pool.acquire((len(rows), self.values.shape[1]))
+				dirty = self.pool.acquire(values.shape, bool)
+
+				numpy.take(self.values, rows, axis=0, out=values)
+				numpy.take(self.dirty, rows, axis=0, out=dirty)
+
+			i = 0
+			while i < num_times:
+				_propagate(self.topology, values, dirty, weights, momentum, incremental, threshold, self.pool)
+
+				i += 1
+
+			if values is not self.values:
+				self.values[rows] = values
+				self.dirty[rows] = dirty
+
+				self.pool.release(values, dirty)
+
+		for layer in self.layers:
+			if layer.propagation != 'max':
+				layer._spread(num_times, threshold)
+
+		for layer in self.layers:
+			layer._sources.clear()
+			layer.version += 1
+
+	def steady_state(self, threshold=1e-4):
+		"""
+			Computes the converged values of each layer, see
+			:meth:`BaseInfluenceMap.steady_state`.
+		"""
+
+		for layer in self.layers:
+			layer.steady_state(threshold)
+
+class InfluenceView(object):
+	"""
+		Lazy arithmetic expression over influence maps. Reading a cell
+		evaluates the expression for that cell only, so combining maps
+		does not allocate or fill a whole new grid.
+
+		For consumers reading every cell, :meth:`materialize` evaluates
+		the expression over the whole grid, and caches the result until
+		one of the underlying dense maps changes.
+	"""
+
+	def __init__(self, op, *operands):
+		"""
+			Creates the view
+
+			:Arguments:
+				* op: Function applied to the values of the operands, works on both floats and arrays
+				* operands: Influence maps, other views or scalars
+		"""
+
+		self.op = op
+		self.operands = operands
+
+		self._cache = (None, None)
+		self._buffer = None
+
+	@property
+	def version(self):
+		"""
+			Combined version of all operands, None if one of the operands
+			can't tell whether it has changed.
+		"""
+
+		versions = []
+		for operand in self.operands:
+			if isinstance(operand, (InfluenceView, BaseInfluenceMap)):
+				version = getattr(operand, 'version', None)
+
+				if version is None:
+					return None
+
+				versions.append((id(operand), version))
+			else:
+				versions.append(operand)
+
+		return tuple(versions)
+
+	def get_influence(self, position):
+		values = [operand.get_influence(position) if isinstance(operand, (InfluenceView, BaseInfluenceMap)) else operand
+			for operand in self.operands]
+
+		return self.op(*values)
+
+	def __getitem__(self, item):
+		return self.get_influence(item)
+
+	def get_shape(self):
+		"""
+			Returns the (width, height) of the grid the view is defined on
+		"""
+
+		for operand in self.operands:
+			if isinstance(operand, InfluenceView):
+				return operand.get_shape()
+			elif isinstance(operand, BaseInfluenceMap):
+				return operand.width, operand.height
+
+		return 0, 0
+
+	def materialize(self):
+		"""
+			Evaluates the expression over the whole grid, and returns an
+			array of shape (width, height). The result is cached as long as
+			the operands don't change, and the same array is overwritten
+			when they do.
+		"""
+
+		version = self.version
+		if version is not None and self._cache[0] == version:
+			return self._cache[1]
+
+		width, height = self.get_shape()
+
+		values = []
+		for operand in self.operands:
+			if isinstance(operand, InfluenceView):
+				values.append(operand.materialize())
+			elif isinstance(operand, BaseInfluenceMap):
+				values.append(operand.get_values())
+			else:
+				values.append(operand)
+
+		# The result is written into the same buffer each time
+		if self._buffer is None:
+			self._buffer = numpy.empty((width, height))
+
+		_UFUNCS[self.op](*values, out=self._buffer)
+		self._cache = (version, self._buffer)
+
+		return self._buffer
+
+	def __add__(self, other):
+		return InfluenceView(operator.add, self, other)
+
+	def __sub__(self, other):
+		return InfluenceView(operator.sub, self, other)
+
+	def __mul__(self, scalar):
+		return InfluenceView(operator.mul, self, scalar)
+
+	def __div__(self, scalar):
+		return InfluenceView(operator.truediv, self, scalar)
+
+	__truediv__ = __div__
+
+# Array versions of the operators used by views
+_UFUNCS = {
+	operator.pos: numpy.positive,
+	operator.add: numpy.add,
+	operator.sub: numpy.subtract,
+	operator.mul: numpy.multiply,
+	operator.truediv: numpy.true_divide
+}
@@ -41,7 +41,7 @@ class FlagSearcherFeatureProvider(BaseFeatureProvider):
 	def get_features(self, state, action):
 		position = (floor(state.position[0]+action[0]), floor(state.position[1]+action[1]))
 
-		min_flag_dist = find_closest([(flag.position.x, flag.position.y) for flag in self.commander.game.enemyFlags], position)
+		min_flag_dist = self.commander.distances.closest([(flag.position.x, flag.position.y) for flag in self.commander.game.enemyFlags], position)
 		min_enemy_dist = find_closest(
 			[(bot.position.x, bot.position.y) for bot in self.commander.game.enemyTeam.members if bot.health > 0 and bot.seenlast < 5],
 			position
@@ -55,7 +55,8 @@ class FlagSearcherFeatureProvider(BaseFeatureProvider):
 		features['enemy-influence'] = self.commander.enemy_influence[position]
 		features['goal-influence'] = self.commander.goal_influence[position]
 		features['visibility'] = self.commander.visibility[position]
-		features['flag-distance'] = 1.0 - (min_flag_dist / max_level_distance)
+		features['threat'] = self.commander.threat[position]
+		features['flag-distance'] = 1.0 - (min(min_flag_dist, max_level_distance) / max_level_distance)
 		features['enemy-distance'] = min_enemy_dist / max_level_distance if min_enemy_dist != sys.maxint else 1.0
 
 		#features.divide_all(10.0)
@@ -76,7 +77,7 @@ class FlagReturnerFeatureProvider(BaseFeatureProvider):
 		position = (floor(state.position[0]+action[0]), floor(state.position[1]+action[1]))
 
 		score_loc = self.commander.game.team.flagScoreLocation
-		score_dist = euclidean_dist((score_loc.x, score_loc.y), position)
+		score_dist = self.commander.distances.distance((score_loc.x, score_loc.y), position)
 		min_enemy_dist = find_closest(
 			[(bot.position.x, bot.position.y) for bot in self.commander.game.enemyTeam.members if bot.health > 0 and bot.seenlast < 5],
 			position
@@ -90,7 +91,8 @@ class FlagReturnerFeatureProvider(BaseFeatureProvider):
 		features['enemy-influence'] = self.commander.enemy_influence[position]
 		features['goal-influence'] = self.commander.goal_influence[position]
 		features['visibility'] = self.commander.visibility[position]
-		features['flag-distance'] = 1.0 - (score_dist / max_level_distance)
+		features['threat'] = self.commander.threat[position]
+		features['flag-distance'] = 1.0 - (min(score_dist, max_level_distance) / max_level_distance)
 		features['enemy-distance'] = min_enemy_dist / max_level_distance if min_enemy_dist != sys.maxint else 1.0
 
 		#features.divide_all(10.0)
@@ -114,6 +114,11 @@ class ApproximateQLearner(BaseQLearner):
 		self.extractor = feature_extractor
 		self.weights = Counter()
 
+		# Features and q-values by (state, action), valid during a single tick
+		self._tick = None
+		self._features = {}
+		self._qvalues = {}
+
 	def set_weights(self, weights):
 		"""
 			Set the weights for the given features
@@ -125,17 +130,53 @@ class ApproximateQLearner(BaseQLearner):
 		for key in weights:
 			self.weights[key] = weights[key]
 
+		self._qvalues.clear()
+
+	def _check_tick(self):
+		"""
+			Clears the caches when a new tick has started, the features
+			depend on the maps of the commander, which change every tick.
+		"""
+
+		if self._tick != self.gamestate.tick:
+			self._tick = self.gamestate.tick
+			self._features.clear()
+			self._qvalues.clear()
+
+	def get_features(self, state, action):
+		"""
+			Returns the features for the (state, action) pair, these are
+			extracted at most once each tick
+		"""
+
+		self._check_tick()
+
+		key = (state, action)
+		features = self._features.get(key)
+
+		if features is None:
+			features = self._features[key] = self.extractor.get_features(state, action)
+
+		return features
 
 	def get_qvalue(self, state, action):
 		"""
 			Returns the q-value based on the given features
 		"""
 
-		features = self.extractor.get_features(state, action)
+		self._check_tick()
 
-		qvalue = 0
-		for feature in features:
-			qvalue += self.weights[feature] * features[feature]
+		key = (state, action)
+		qvalue = self._qvalues.get(key)
+
+		if qvalue is None:
+			features = self.get_features(state, action)
+
+			qvalue = 0
+			for feature in features:
+				qvalue += self.weights[feature] * features[feature]
+
+			self._qvalues[key] = qvalue
 
 		return qvalue
 
@@ -149,7 +190,7 @@ class ApproximateQLearner(BaseQLearner):
 
 		print "UPDATE -------"
 		correction = reward + self.gamma * self.get_value(next_state) - self.get_qvalue(state, action)
-		features = self.extractor.get_features(state, action)
+		features = self.get_features(state, action)
 		print "Reward:", reward
 		print "Gamma:", self.gamma
 		print "Correction:", correction
@@ -161,5 +202,5 @@ class ApproximateQLearner(BaseQLearner):
 
 		print
 
-
-
+		# The weights changed, so all q-values are different now
+		self._qvalues.clear()
@@ -12,6 +12,7 @@ game info to each bot.
 """
 
 from math import floor
+import numpy
 
 # Define some actions a bot can take
 MOVE_N = (0, 1)
@@ -34,6 +35,12 @@ ACTIONS = (
 	MOVE_SW
 )
 
+# Legal actions for each 8-bit move mask, bit i set for ACTIONS[i]
+_ACTIONS_BY_MASK = tuple(
+	tuple(action for bit, action in enumerate(ACTIONS) if mask & (1 << bit))
+	for mask in xrange(256)
+)
+
 class GameState(object):
 	"""
 		Overall game state
@@ -42,58 +49,140 @@ class GameState(object):
 	def __init__(self, commander):
 		self.commander = commander
 
-		self.blocked = []
+		self.width = self.commander.level.width
+		self.height = self.commander.level.height
+
+		# Dense grids of the level, indexed by [x, y], shared by the other modules
+		self.heights = numpy.array(self.commander.level.blockHeights, dtype=float).reshape((self.width, self.height))
+		self.blocked = self.heights > 0
+		self.blocks_sight = self.heights > 1
+
+		# Move mask of each cell, bit i set if ACTIONS[i] leads to a free cell in the level
+		self.moves = numpy.zeros((self.width, self.height), dtype=numpy.uint8)
+
+		for bit, (dx, dy) in enumerate(ACTIONS):
+			source = (slice(max(0, -dx), self.width - max(0, dx)), slice(max(0, -dy), self.height - max(0, dy)))
+			target = (slice(max(0, dx), self.width + min(0, dx)), slice(max(0, dy), self.height + min(0, dy)))
 
-		for x, ylist in enumerate(self.commander.level.blockHeights):
-			for y, value in enumerate(ylist):
-				if value > 0:
-					self.blocked.append((x, y))
+			self.moves[source] |= (~self.blocked[target]).astype(numpy.uint8) << bit
+
+		# Moves of each cell leading to a cell occupied by one of our bots, rebuilt each tick
+		self.occupied = numpy.zeros((self.width, self.height), dtype=numpy.uint8)
+
+		# Shared BotState of each cell, created when first asked for
+		self._states = [None] * (self.width * self.height)
+
+		self.tick = 0
+		self.update()
+
+	def bot_state(self, x, y):
+		"""
+			Returns the BotState for the cell containing (x, y). Each cell
+			has a single instance, so states can be compared and hashed cheaply.
+		"""
+
+		x, y = int(floor(x)), int(floor(y))
+
+		if x < 0 or y < 0 or x >= self.width or y >= self.height:
+			return BotState(x, y)
+
+		index = x*self.height + y
+		state = self._states[index]
+
+		if state is None:
+			state = self._states[index] = BotState(x, y, index)
+
+		return state
+
+	def update(self):
+		"""
+			Rebuilds the occupancy masks from the positions of our bots,
+			should be called once each tick. Values cached per tick are
+			invalidated by the new :attr:`tick` number.
+		"""
+
+		self.tick += 1
+		self.occupied.fill(0)
+
+		for bot in self.commander.game.team.members:
+			if bot.health > 0:
+				x, y = int(floor(bot.position.x)), int(floor(bot.position.y))
+
+				for bit, (dx, dy) in enumerate(ACTIONS):
+					sx, sy = x - dx, y - dy
+
+					if 0 <= sx < self.width and 0 <= sy < self.height:
+						self.occupied.itemset((sx, sy), self.occupied.item(sx, sy) | (1 << bit))
 
 	def is_blocked(self, *args):
 		if len(args) == 1:
-			return args[0] in self.blocked
+			x, y = args[0]
 		else:
-			return (args[0], args[1]) in self.blocked
+			x, y = args[0], args[1]
 
-	def get_legal_actions(self, bot_state):
-		actions = []
+		x, y = int(floor(x)), int(floor(y))
+		if x < 0 or y < 0 or x >= self.width or y >= self.height:
+			return False
+
+		return self.blocked.item(x, y)
+
+	def are_blocked(self, positions):
+		"""
+			Vectorized version of `is_blocked`, returns a boolean array
+			for an array like of (x, y) positions
+		"""
 
-		for action in ACTIONS:
-			new_pos = (floor(bot_state[0] + action[0]), floor(bot_state[1] + action[1]))
+		positions = numpy.floor(numpy.asarray(positions, dtype=float).reshape(-1, 2)).astype(numpy.intp)
+		xs, ys = positions[:, 0], positions[:, 1]
 
-			if new_pos[0] < 0 or new_pos[1] < 0:
-				continue
+		inside = (xs >= 0) & (ys >= 0) & (xs < self.width) & (ys < self.height)
 
-			if new_pos[0] >= self.commander.level.width or new_pos[1] >= self.commander.level.height:
-				continue
+		result = numpy.zeros(len(positions), dtype=bool)
+		result[inside] = self.blocked[xs[inside], ys[inside]]
 
-			occupied = False
-			for bot in self.commander.game.team.members:
-				if bot.health > 0:
-					if (floor(bot.position.x), floor(bot.position.y)) == new_pos:
-						occupied = True
-						break
+		return result
 
-			if not self.is_blocked(new_pos) and not occupied:
-				actions.append(action)
+	def get_legal_actions(self, bot_state):
+		"""
+			Returns a tuple with the actions which lead to a free and
+			unoccupied cell. Occupancy is as of the last call to `update`.
+		"""
+
+		x, y = int(bot_state[0]), int(bot_state[1])
+
+		if x < 0 or y < 0 or x >= self.width or y >= self.height:
+			return ()
 
-		return actions
+		return _ACTIONS_BY_MASK[self.moves.item(x, y) & ~self.occupied.item(x, y)]
 
 class BotState(object):
 	"""
 		A state class for bots used for Q-learning, Only contains
 		the position.
+
+		States are hashable, so they can be used as cache keys. Use
+		`GameState.bot_state` to get the shared instance for a cell.
 	"""
 
-	def __init__(self, x, y):
+	__slots__ = ('position', 'index')
+
+	def __init__(self, x, y, index=None):
 		"""
-			Initialize the state
+			Initialize the state, `index` is the flat index of the cell in
+			the level grids, if known
 		"""
 
 		self.position = (floor(x), floor(y))
+		self.index = index
 
 	def __eq__(self, other):
 		return self.position == other.position
 
+	def __ne__(self, other):
+		return self.position != other.position
+
+	def __hash__(self):
+		return hash(self.position)
+
 	def __getitem__(self, item):
-		return self.position[item]
\ No newline at end of file
+		return self.position[item]
@@ -0,0 +1,133 @@
+"""
+:mod:`starkai.threatmap` - Cells enemies can currently fire at
+==============================================================
+
+This module contains a map with, for each cell, the part of the
+visible enemies which can fire at it. It is rebuilt each tick from the
+positions and facing directions of the enemies, using view waves limited
+to the firing distance and field of view.
+
+.. module:: starkai.threatmap
+   :synopsis: Per tick enemy threat map
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+from __future__ import division
+from math import atan2, cos, pi, sin
+import numpy
+
+from starkai.visibility import BitmapWave
+from starkai.util import LRUCache
+
+class ThreatMap(object):
+	"""
+		Threat of each cell, the fraction of the tracked enemies which have
+		the cell within their firing distance and field of view.
+
+		The cells seen by an enemy are cached per cell and heading, so
+		enemies standing still or returning to the same pose are cheap.
+	"""
+
+	# Number of heading buckets used as cache key
+	HEADINGS = 32
+
+	def __init__(self, width, height, blocked, radius, capacity=1024):
+		"""
+			:Arguments:
+				* width, height: Dimensions of the level
+				* blocked: Bytearray indexed by ``x * height + y``, nonzero for cells which block sight
+				* radius: Firing distance of the enemies
+				* capacity: Number of cached view cones
+		"""
+
+		self.width = width
+		self.height = height
+		self.radius = radius
+
+		self.wave = BitmapWave((width, height), blocked)
+		self.cones = LRUCache(capacity)
+
+		self.values = numpy.zeros((width, height))
+		self.version = 0
+
+	def cone(self, position, facing=None, fov=None):
+		"""
+			Returns the flat indices of the cells an enemy at `position`
+			can fire at. Without a facing direction or field of view, or
+			with a field of view of a full circle, all cells within the
+			radius are returned. A field of view of zero only covers the
+			cell of the enemy itself.
+		"""
+
+		x, y = int(position[0]), int(position[1])
+
+		if facing is None or fov is None or fov >= 2*pi:
+			heading = fov = None
+		else:
+			heading = int(round(atan2(facing[1], facing[0]) / (2*pi) * self.HEADINGS)) % self.HEADINGS
+			fov = max(round(fov, 3), 0.0)
+
+		key = (x, y, heading, fov)
+		cells = self.cones.get(key)
+
+		if cells is None:
+			if fov == 0.0:
+				cells = numpy.array([x * self.height + y])
+			elif heading is None:
+				visible = self.wave.compute((x + 0.5, y + 0.5), radius=self.radius)
+				cells = numpy.flatnonzero(numpy.frombuffer(visible, dtype=numpy.uint8))
+			else:
+				angle = heading * 2*pi / self.HEADINGS
+
+				if fov < pi:
+					visible = self.wave.compute((x + 0.5, y + 0.5), radius=self.radius, facing=(cos(angle), sin(angle)),
+						fov=fov)
+					cells = numpy.flatnonzero(numpy.frombuffer(visible, dtype=numpy.uint8))
+				else:
+					# Waves can't be limited to a cone wider than a half plane, the whole disc is filtered instead
+					visible = self.wave.compute((x + 0.5, y + 0.5), radius=self.radius)
+					cells = numpy.flatnonzero(numpy.frombuffer(visible, dtype=numpy.uint8))
+
+					xs, ys = numpy.divmod(cells, self.height)
+					offsets = (numpy.arctan2(ys - y, xs - x) - angle + pi) % (2*pi) - pi
+					cells = cells[(numpy.abs(offsets) <= fov / 2) | (cells == x * self.height + y)]
+
+			self.cones[key] = cells
+
+		return cells
+
+	def update(self, enemies):
+		"""
+			Rebuilds the map.
+
+			:Arguments:
+				* enemies: Iterable of (position, facing, fov) tuples, one for each enemy to take into account
+		"""
+
+		self.values.fill(0.0)
+		flat = self.values.reshape(-1)
+
+		count = 0
+		for position, facing, fov in enemies:
+			if 0 <= position[0] < self.width and 0 <= position[1] < self.height:
+				flat[self.cone(position, facing, fov)] += 1.0
+				count += 1
+
+		if count:
+			self.values /= count
+
+		self.version += 1
+
+	def get_influence(self, position):
+		x, y = int(position[0]), int(position[1])
+
+		if not (0 <= x < self.width and 0 <= y < self.height):
+			return 0.0
+
+		return self.values.item(x, y)
+
+	def __getitem__(self, position):
+		return self.get_influence(position)
+
+	def get_values(self):
+		return self.values
@@ -10,6 +10,7 @@ This module contains a class for creating and modifying influence maps.
 .. moduleauthor:: Lucas van Dijk <info@return1.net>
 """
 from __future__ import division
+from collections import OrderedDict
 import math
 import functools
 import random
@@ -44,6 +45,52 @@ def find_closest(iterable, position):
 
 	return min_dist
 
+class LRUCache(object):
+	"""
+		A mapping with a maximum size. When it is full, the least recently
+		used key is evicted.
+	"""
+
+	def __init__(self, capacity=1024):
+		self.capacity = capacity
+		self.items = OrderedDict()
+
+	def get(self, key, default=None):
+		"""
+			Returns the value for `key`, and marks it as recently used.
+		"""
+
+		try:
+			value = self.items.pop(key)
+		except KeyError:
+			return default
+
+		self.items[key] = value
+		return value
+
+	def __setitem__(self, key, value):
+		self.items.pop(key, None)
+		self.items[key] = value
+
+		if len(self.items) > self.capacity:
+			self.items.popitem(last=False)
+
+	def __contains__(self, key):
+		return key in self.items
+
+	def iteritems(self):
+		"""
+			Iterates over the keys and values, without marking them as used
+		"""
+
+		return self.items.iteritems()
+
+	def __len__(self):
+		return len(self.items)
+
+	def clear(self):
+		self.items.clear()
+
 class Counter(dict):
 	"""
 		A counter keeps track of counts for a set of keys.
@@ -1,9 +1,12 @@
 from itertools import izip
-from math import floor, copysign
-from api import Vector2
+from math import atan2, ceil, copysign, floor, pi, sqrt, tan
+import numpy
 
 sign = lambda x: int(copysign(1, x))
 
+# Byte value used for set cells in the bitmaps
+SET = '\x01'
+
 
 def line(A, B, finite = True, covering = True):
     """
@@ -105,165 +108,487 @@ def line(A, B, finite = True, covering = True):
 
 
 
-class Wave(object):
+def rasterize(starts, ends):
     """
-        Visibility "wave" helper that can calculate all visible cells from a
-    single cell.  It starts from a specified point and "flood fills" cells that
-    are visible in four different directions.  Each direction of the visibility
-    wave is bounded by two lines, which are then rasterized in between.  If
-    obstacles are encountered, the wave is split into sub-waves as necessary.
+        Batch version of tracing the cells crossed by many segments at once.
+    Returns three index arrays: the segment of each cell, and its x and y
+    coordinates.  The cells of each segment are in the order they are crossed,
+    starting with the cell of its start point.  When a segment passes exactly
+    through a corner, the cell stepped to in y comes first.
+
+    @param starts   Array like of shape (n, 2) with the start points.
+    @param ends     Array like of shape (n, 2) with the end points.
+    """
+    starts = numpy.asarray(starts, dtype=float).reshape(-1, 2)
+    ends = numpy.asarray(ends, dtype=float).reshape(-1, 2)
+    n = len(starts)
+
+    first = numpy.floor(starts).astype(numpy.intp)
+    delta = ends - starts
+    step = numpy.where(delta > 0, 1, -1)
+    crossings = numpy.abs(numpy.floor(ends).astype(numpy.intp) - first)
+
+    # Every crossing of a cell border, with its position along the segment.
+    segments, axes, positions = [], [], []
+    for axis in (0, 1):
+        count = crossings[:, axis]
+        segment = numpy.repeat(numpy.arange(n), count)
+        k = numpy.arange(count.sum()) - numpy.repeat(numpy.cumsum(count) - count, count)
+
+        border = first[segment, axis] + numpy.where(step[segment, axis] > 0, k + 1, -k)
+        segments.append(segment)
+        axes.append(numpy.repeat(axis, len(segment)))
+        positions.append((border - starts[segment, axis]) / delta[segment, axis])
+
+    segment = numpy.concatenate(segments)
+    axis = numpy.concatenate(axes)
+    order = numpy.lexsort((1 - axis, numpy.concatenate(positions), segment))
+    segment, axis = segment[order], axis[order]
+
+    # Count the steps in each direction since the start of the segment.
+    totals = crossings.sum(axis=1)
+    offsets = numpy.cumsum(totals) - totals
+    steps_x = numpy.cumsum(axis == 0)
+    steps_y = numpy.cumsum(axis == 1)
+    base = offsets[segment]
+    steps_x = steps_x - numpy.concatenate(([0], steps_x))[base]
+    steps_y = steps_y - numpy.concatenate(([0], steps_y))[base]
+
+    # Start cells go before the crossings of their segment.
+    size = n + len(segment)
+    cells = numpy.empty((size, 3), dtype=numpy.intp)
+
+    heads = offsets + numpy.arange(n)
+    cells[heads, 0] = numpy.arange(n)
+    cells[heads, 1:] = first
+
+    rest = numpy.arange(len(segment)) + segment + 1
+    cells[rest, 0] = segment
+    cells[rest, 1] = first[segment, 0] + step[segment, 0]*steps_x
+    cells[rest, 2] = first[segment, 1] + step[segment, 1]*steps_y
+
+    return cells[:, 0], cells[:, 1], cells[:, 2]
+
+
+def ray(ax, ay, ux, uy):
+    """
+        Tuple based equivalent of ``line(A, A+u, finite = False, covering = False)``,
+    which doesn't allocate any `Vector2` objects.
     """
 
-    def __init__(self, (width, height), isBlocked, setVisible):
+    # Same rounding as the subtraction B - A in line()
+    dx = (ax + ux) - ax
+    dy = (ay + uy) - ay
+
+    if abs(dx) >= abs(dy):
+        sy = dy / abs(dx)
+        sx = sign(dx)
+
+        y = int(floor(ay))
+        x = int(floor(ax))
+        e = ay - float(y)
+
+        while True:
+            yield (x, y)
+
+            e += sy
+            if e >= 1.0:
+                e -= 1.0
+                y += 1
+            elif e < 0.0:
+                e += 1.0
+                y -= 1
+
+            x += sx
+
+    else:
+        sx = dx / abs(dy)
+        sy = sign(dy)
+
+        x = int(floor(ax))
+        y = int(floor(ay))
+        e = ax - float(x)
+
+        while True:
+            yield (x, y)
+
+            e += sx
+            if e >= 1.0:
+                e -= 1.0
+                x += 1
+            elif e < 0.0:
+                e += 1.0
+                x -= 1
+
+            y += sy
+
+
+class BitmapWave(object):
+    """
+        Array based version of the visibility wave.  Instead of calling back for
+    each cell, it reads a blocked bitmap and marks visible cells in a bytearray.
+    Both are indexed by ``x * height + y``.  Columns and rows are scanned with
+    `bytearray.find` and marked with slice assignments, so the work per cell is
+    done in C, and the Python code only runs per column and per split.
+    """
+
+    def __init__(self, (width, height), blocked):
         self.width = width
         self.height = height
-        self.isBlocked = isBlocked
-        self.setVisible = setVisible
 
-    def xwave_internal(self, p, upper, lower, direction):
-        """Propagate a visibility wave along one direction with X-major axis."""
+        if not isinstance(blocked, bytearray):
+            blocked = bytearray(1 if b else 0 for b in blocked)
+        self.blocked = blocked
+
+        # Transposed copy, so rows can be scanned as contiguous runs too
+        self.blocked_t = bytearray(blocked[x*height + y] for y in xrange(height) for x in xrange(width))
+
+        self.visible = bytearray(width * height)
+        self._empty = bytearray(width * height)
+        self._runs = [bytearray(SET * n) for n in xrange(max(width, height) + 1)]
+        self._far = float(width + height)
+
+    def split(self, cells, start, n, b, vstart, vstep, mlo, mhi):
+        """
+            Marks the free cells of cells[start:start+n] as visible, where `b`
+        is the first blocked cell.  The visible cells are written to the range
+        starting at `vstart` with step `vstep`, but only those with an offset
+        between `mlo` and `mhi`.  Returns the offsets of the first and last
+        cell of each run of free cells.
+        """
+
+        spans = []
+        visible = self.visible
+        runs = self._runs
+        stop = start + n
+        pos = start
+
+        while pos < stop:
+            if b < 0:
+                b = stop
+
+            if b > pos:
+                first, last = pos - start, b - start
+                spans.append((first, last-1))
+
+                if first < mlo: first = mlo
+                if last > mhi: last = mhi
+                if last > first:
+                    visible[vstart+first*vstep:vstart+last*vstep:vstep] = runs[last-first]
+
+            pos = b + 1
+            b = cells.find(SET, pos, stop)
+
+        return spans
+
+    def clip(self, d, limits):
+        """
+            Returns the range of offsets across the wave axis which are within
+        the radius and cone in `limits`, for a column at distance `d` along the
+        axis.  Returns None if the column is beyond the radius.
+        """
+
+        normal, tlo, thi, r2 = limits
+        lo, hi = -self._far, self._far
+
+        if r2 is not None:
+            if d*d > r2:
+                return None
+
+            hi = sqrt(r2 - d*d)
+            lo = -hi
+
+        if tlo is not None:
+            a, b = d*tlo*normal, d*thi*normal
+            if a > b: a, b = b, a
+            if a > lo: lo = a
+            if b < hi: hi = b
+
+        return lo, hi
+
+    def xwave_internal(self, px, py, upper, lower, axis = 1, limits = None):
+        """
+            Propagate a visibility wave along one direction with X-major axis.
+        Sub-waves are kept on an explicit stack instead of recursing, so
+        cluttered or large levels can't hit the recursion limit.
+        """
+
+        stack = [(upper, lower)]
+        while stack:
+            upper, lower = stack.pop()
+
+            for (ux, uy), (lx, ly) in izip(upper, lower):
+                assert ux == lx, "{} != {}".format(ux, lx)
+                x = ux
+                # If the upper and lower bounds are switched, just swap them.
+                if uy > ly: uy, ly = ly, uy
+
+                # Check if the wave has stepped out of bounds.
+                if x < 0: break
+                if x >= self.width: break
+
+                # Stop at the radius, and only mark the cells within the radius and cone.
+                if limits is not None:
+                    clipped = self.clip((x + 0.5 - px)*axis, limits)
+                    if clipped is None: break
+                    mlo, mhi = int(ceil(py + clipped[0] - 0.5)), int(floor(py + clipped[1] - 0.5)) + 1
+                else:
+                    mlo, mhi = 0, self.height
 
-        for (ux, uy), (lx, ly) in izip(upper, lower):
-            assert ux == lx, "{} != {}".format(ux, lx)
-            x = ux
-            # If the upper and lower bounds are switched, just swap them.
-            if uy > ly: uy, ly = ly, uy
+                lo = uy if uy > 0 else 0
+                hi = ly+1 if ly < self.height else self.height
+                if hi <= lo:
+                    continue
 
-            # Check if the wave has stepped out of bounds.
-            if x < 0: break
-            if x >= self.width: break
+                mlo = mlo if mlo > lo else lo
+                mhi = mhi if mhi < hi else hi
 
-            waves = []
-            visible = []
-            blocks = False
+                # Mark all free cells in this column, or find the runs between blocks.
+                start = x*self.height + lo
+                b = self.blocked.find(SET, start, start + hi - lo)
+                if b < 0:
+                    if mhi > mlo:
+                        self.visible[start + mlo - lo:start + mhi - lo] = self._runs[mhi - mlo]
+                    continue
 
-            # Now iterate through all the pixels in this column.
-            for y in range(max(uy, 0), min(ly+1, self.height)):
+                spans = self.split(self.blocked, start, hi - lo, b, start, 1, mlo - lo, mhi - lo)
+
+                # Split the wave into sub-waves if there were blocks.
+                waves = []
+                for i, (first, last) in enumerate(spans):
+                    first += lo
+                    last += lo
 
-                # If a free cell is encountered, store it for later.
-                if not self.isBlocked(x, y):
-                    visible.append((x, y))
-                    self.setVisible(x, y)
-                # If the cell is blocked, then we keep track of the entire span of cells.
-                else:
-                    blocks = True
-                    if visible:
-                        waves.append(visible)
-                        visible = []
-                    else:
-                        pass
-        
-            # Now we have a list of all the visible spans of cells, for sub-waves.
-            if visible:
-                waves.append(visible)
-                visible = []
-
-            # Split the wave into sub-waves if there were blocks.
-            if blocks:
-                for i, w in enumerate(waves):
                     # Calculate the coordinates of the start and end of the new wave.
-                    w0, wn = Vector2(w[0][0]+0.5, w[0][1]+0.5), Vector2(w[-1][0]+0.5, w[-1][1]+0.5)
-                    u = w0 - p
-                    l = wn - p
-                    u = u / abs(u.x)
-                    l = l / abs(l.x)
+                    w0x, w0y = x+0.5, first+0.5
+                    wnx, wny = x+0.5, last+0.5
+                    ux, uy = w0x - px, w0y - py
+                    vx, vy = wnx - px, wny - py
+                    d = abs(ux)
+                    ux, uy = ux / d, uy / d
+                    d = abs(vx)
+                    vx, vy = vx / d, vy / d
 
                     # Adjustment for error case dy>dx is caused by sub-pixel drift.
-                    if abs(u.y)>abs(u.x): u.y=abs(u.x)*sign(u.y)
-                    if abs(l.y)>abs(l.x): l.y=abs(l.x)*sign(l.y)
-                    w0 += u
-                    wn += l
+                    if abs(uy)>abs(ux): uy=abs(ux)*sign(uy)
+                    if abs(vy)>abs(vx): vy=abs(vx)*sign(vy)
+                    w0x += ux
+                    w0y += uy
+                    wnx += vx
+                    wny += vy
 
                     # If this wave cell is the first or last, we use the exact same line equation.
-                    if i>0 or w[0][1] > max(uy, 0):
-                        uppr = line(w0, w0+u, finite = False, covering = False)
+                    if i>0 or first > lo:
+                        uppr = ray(w0x, w0y, ux, uy)
                     else:
                         uppr = upper
-                    if i<len(waves)-1 or w[-1][1] < min(ly+1, self.height)-1:
-                        lowr = line(wn, wn+l, finite = False, covering = False)
+                    if i<len(spans)-1 or last < hi-1:
+                        lowr = ray(wnx, wny, vx, vy)
                     else:
                         lowr = lower
 
-                    # Now recursively handle this case, propagating the sub-wave further.
-                    self.xwave_internal(p, uppr, lowr, direction)
-                return
-
-    def ywave_internal(self, p, upper, lower, direction):
-        for (ux, uy), (lx, ly) in izip(upper, lower):
-            assert uy == ly, "{} != {}".format(uy, ly)
-            y = uy
-
-            if ux > lx: ux, lx = lx, ux
-
-            if y < 0: break
-            if y >= self.height: break
-
-            waves = []
-            visible = []
-            blocks = False
-            for x in range(max(ux, 0), min(lx+1, self.width)):
-                if self.isBlocked(x, y):
-                    blocks = True
-                    if visible:
-                        waves.append(visible)
-                        visible = []
-                    else:
-                        pass
+                    # Now handle this case, propagating the sub-wave further.
+                    waves.append((uppr, lowr))
+
+                # Continue with the sub-waves, in the same order as a recursive wave would.
+                stack.extend(reversed(waves))
+                break
+
+    def ywave_internal(self, px, py, upper, lower, axis = 1, limits = None):
+        """Propagate a visibility wave along one direction with Y-major axis."""
+
+        stack = [(upper, lower)]
+        while stack:
+            upper, lower = stack.pop()
+
+            for (ux, uy), (lx, ly) in izip(upper, lower):
+                assert uy == ly, "{} != {}".format(uy, ly)
+                y = uy
+
+                if ux > lx: ux, lx = lx, ux
+
+                if y < 0: break
+                if y >= self.height: break
+
+                if limits is not None:
+                    clipped = self.clip((y + 0.5 - py)*axis, limits)
+                    if clipped is None: break
+                    mlo, mhi = int(ceil(px + clipped[0] - 0.5)), int(floor(px + clipped[1] - 0.5)) + 1
                 else:
-                    visible.append((x,y))
-                    self.setVisible(x, y)
-        
-            if visible:
-                waves.append(visible)
-                visible = []
-
-            if blocks:
-                for i, w in enumerate(waves):
-                    w0, wn = Vector2(w[0][0]+0.5, w[0][1]+0.5), Vector2(w[-1][0]+0.5, w[-1][1]+0.5)
-                    u = w0 - p
-                    l = wn - p
-                    u = u / abs(u.y)
-                    l = l / abs(l.y)
-
-                    if abs(u.x)>abs(u.y): u.x=abs(u.y)*sign(u.x)
-                    if abs(l.x)>abs(l.y): l.x=abs(l.y)*sign(l.x)
-                    w0 += u
-                    wn += l
-                    if i>0 or w[0][0] > max(ux, 0):
-                        uppr = line(w0, w0+u, finite = False, covering = False)
+                    mlo, mhi = 0, self.width
+
+                lo = ux if ux > 0 else 0
+                hi = lx+1 if lx < self.width else self.width
+                if hi <= lo:
+                    continue
+
+                mlo = mlo if mlo > lo else lo
+                mhi = mhi if mhi < hi else hi
+
+                # Rows are scanned in the transposed bitmap, but marked in the normal one.
+                start = y*self.width + lo
+                b = self.blocked_t.find(SET, start, start + hi - lo)
+                if b < 0:
+                    if mhi > mlo:
+                        self.visible[mlo*self.height + y:mhi*self.height + y:self.height] = self._runs[mhi - mlo]
+                    continue
+
+                spans = self.split(self.blocked_t, start, hi - lo, b, lo*self.height + y, self.height, mlo - lo, mhi - lo)
+
+                waves = []
+                for i, (first, last) in enumerate(spans):
+                    first += lo
+                    last += lo
+
+                    w0x, w0y = first+0.5, y+0.5
+                    wnx, wny = last+0.5, y+0.5
+                    ux, uy = w0x - px, w0y - py
+                    vx, vy = wnx - px, wny - py
+                    d = abs(uy)
+                    ux, uy = ux / d, uy / d
+                    d = abs(vy)
+                    vx, vy = vx / d, vy / d
+
+                    if abs(ux)>abs(uy): ux=abs(uy)*sign(ux)
+                    if abs(vx)>abs(vy): vx=abs(vy)*sign(vx)
+                    w0x += ux
+                    w0y += uy
+                    wnx += vx
+                    wny += vy
+                    if i>0 or first > lo:
+                        uppr = ray(w0x, w0y, ux, uy)
                     else:
                         uppr = upper
-                    if i<len(waves)-1 or w[-1][0] < min(lx+1, self.width)-1:
-                        lowr = line(wn, wn+l, finite = False, covering = False)
+                    if i<len(spans)-1 or last < hi-1:
+                        lowr = ray(wnx, wny, vx, vy)
                     else:
                         lowr = lower
 
-                    self.ywave_internal(p, uppr, lowr, direction)
-                return
+                    waves.append((uppr, lowr))
+
+                # Continue with the sub-waves, in the same order as a recursive wave would.
+                stack.extend(reversed(waves))
+                break
+
+    def limits(self, axis, normal, radius, facing, fov):
+        """
+            Returns the limits of a wave along `axis`, with the cone expressed
+        as the tangents of its edges relative to the axis.  Returns False if
+        the cone is completely behind the wave.
+        """
+
+        if radius is None and facing is None:
+            return None
+
+        tlo = thi = None
+        if facing is not None:
+            # Angle of the facing direction relative to the axis
+            angle = atan2(facing[0]*normal[0] + facing[1]*normal[1], facing[0]*axis[0] + facing[1]*axis[1])
+            lo = max(angle - fov/2.0, -pi/2.0 + 1e-9)
+            hi = min(angle + fov/2.0, pi/2.0 - 1e-9)
+
+            if lo > hi:
+                return False
+
+            tlo, thi = tan(lo), tan(hi)
+
+        return (normal[0] + normal[1], tlo, thi, radius*radius if radius is not None else None)
+
+    def compute(self, p, visible = None, radius = None, facing = None, fov = None):
+        """
+            Propagate four visibility waves, along X and Y both positive and
+        negative.  Returns the bytearray with the cells visible from `p`, which
+        is :attr:`visible` unless another array is passed in.
+
+        @param radius   Only cells with their center within this distance are
+                        visible, and the waves stop at it.
+        @param facing   Direction of a view cone, with `fov` its full angle in
+                        radians.  Waves outside the cone aren't computed at all.
+        """
+
+        if visible is None:
+            visible = self.visible
+        visible[:] = self._empty
+        self.visible = visible
+
+        px, py = (p.x, p.y) if hasattr(p, 'x') else p
+        px, py = float(px), float(py)
+
+        if facing is not None:
+            facing = (facing.x, facing.y) if hasattr(facing, 'x') else facing
+            if fov is None or fov >= pi:
+                facing = None
+
+        origin = int(px)*self.height + int(py)
+        if self.blocked[origin]:
+            return visible
+
+        # The cell of the origin itself is always visible, whatever the limits
+        visible[origin] = 1
 
-    def compute(self, p):
-        """Propagate four visibility waves, along X and Y both positive and negative."""
+        limits = self.limits((+1, 0), (0, +1), radius, facing, fov)
+        if limits is not False:
+            upper = ray(px, py, +0.5, -0.5)
+            lower = ray(px, py, +0.5, +0.5)
+            self.xwave_internal(px, py, upper, lower, +1, limits)
 
-        if self.isBlocked(int(p.x), int(p.y)):
-            return
+        limits = self.limits((-1, 0), (0, -1), radius, facing, fov)
+        if limits is not False:
+            upper = ray(px, py, -0.5, -0.5)
+            lower = ray(px, py, -0.5, +0.5)
 
-        upper = line(p, p+Vector2(+0.5, -0.5), finite = False, covering = False)
-        lower = line(p, p+Vector2(+0.5, +0.5), finite = False, covering = False)
-        self.xwave_internal(p, upper, lower, Vector2(+1.0, 0.0))
+            upper.next(), lower.next()
+            self.xwave_internal(px, py, upper, lower, -1, limits)
+
+        limits = self.limits((0, -1), (+1, 0), radius, facing, fov)
+        if limits is not False:
+            upper = ray(px, py - 1.0, -0.5, -0.5)
+            lower = ray(px, py - 1.0, +0.5, -0.5)
+            self.ywave_internal(px, py, upper, lower, -1, limits)
+
+        limits = self.limits((0, +1), (-1, 0), radius, facing, fov)
+        if limits is not False:
+            upper = ray(px, py + 1.0, -0.5, +0.5)
+            lower = ray(px, py + 1.0, +0.5, +0.5)
+            self.ywave_internal(px, py, upper, lower, +1, limits)
+
+        return visible
+
+
+class Wave(object):
+    """
+        Visibility "wave" helper that can calculate all visible cells from a
+    single cell.  It starts from a specified point and "flood fills" cells that
+    are visible in four different directions.  Each direction of the visibility
+    wave is bounded by two lines, which are then rasterized in between.  If
+    obstacles are encountered, the wave is split into sub-waves as necessary.
+
+        This is a wrapper around `BitmapWave` for callers using callbacks.
+    `isBlocked` is sampled for every cell once, on the first call to compute.
+    """
+
+    def __init__(self, (width, height), isBlocked, setVisible):
+        self.width = width
+        self.height = height
+        self.isBlocked = isBlocked
+        self.setVisible = setVisible
+        self.wave = None
 
-        upper = line(p, p+Vector2(-0.5, -0.5), finite = False, covering = False)
-        lower = line(p, p+Vector2(-0.5, +0.5), finite = False, covering = False)
+    def compute(self, p, radius = None, facing = None, fov = None):
+        """Calls setVisible for each cell visible from p, see `BitmapWave.compute`."""
 
-        upper.next(), lower.next()
-        self.xwave_internal(p, upper, lower, Vector2(-1.0, 0.0))
+        if self.wave is None:
+            blocked = bytearray(self.width * self.height)
+            for x in xrange(self.width):
+                for y in xrange(self.height):
+                    if self.isBlocked(x, y):
+                        blocked[x*self.height + y] = 1
 
-        p0 = p + Vector2(0.0, -1.0)
-        upper = line(p0, p0+Vector2(-0.5, -0.5), finite = False, covering = False)
-        lower = line(p0, p0+Vector2(+0.5, -0.5), finite = False, covering = False)
-        self.ywave_internal(p, upper, lower, Vector2(0.0, -1.0))
+            self.wave = BitmapWave((self.width, self.height), blocked)
 
-        p1 = p + Vector2(0.0, +1.0)
-        upper = line(p1, p1+Vector2(-0.5, +0.5), finite = False, covering = False)
-        lower = line(p1, p1+Vector2(+0.5, +0.5), finite = False, covering = False)
-        self.ywave_internal(p, upper, lower, Vector2(0.0, +1.0))
+        visible = self.wave.compute(p, radius = radius, facing = facing, fov = fov)
 
+        i = visible.find(SET)
+        while i >= 0:
+            self.setVisible(*divmod(i, self.height))
+            i = visible.find(SET, i+1)
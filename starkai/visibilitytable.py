@@ -0,0 +1,298 @@
+"""
+:mod:`starkai.visibilitytable` - Precomputed visibility between cells
+=====================================================================
+
+This module contains a table with the visibility of every cell of a
+level from every other cell. Building it takes a while, so it is
+stored on disk per level and memory-mapped on later matches.
+
+.. module:: starkai.visibilitytable
+   :synopsis: Precomputed visibility tables
+
+.. moduleauthor:: Lucas van Dijk <info@return1.net>
+"""
+from __future__ import division
+from os.path import dirname, exists, join
+import hashlib
+import multiprocessing
+import os
+import sys
+import numpy
+
+from starkai.visibility import BitmapWave, rasterize
+from starkai.util import LRUCache
+
+# Directory where tables are stored, one file per level
+CACHE_DIRECTORY = join(dirname(__file__), 'cache')
+
+# Wave used by a worker process, set up by _init_worker
+_worker_wave = None
+
+def _init_worker(width, height, blocked):
+	global _worker_wave
+	_worker_wave = BitmapWave((width, height), blocked)
+
+def _compute_rows(origins, wave=None):
+	"""
+		Returns the given flat origin indices, and the packed rows with the
+		cells visible from each of them.
+	"""
+
+	if wave is None:
+		wave = _worker_wave
+
+	visible = numpy.frombuffer(wave.visible, dtype=numpy.uint8)
+	rows = numpy.empty((len(origins), (len(visible) + 7) // 8), dtype=numpy.uint8)
+
+	for i, origin in enumerate(origins):
+		x, y = divmod(int(origin), wave.height)
+
+		wave.compute((x + 0.5, y + 0.5))
+		rows[i] = numpy.packbits(visible)
+
+	return origins, rows
+
+def fingerprint(width, height, blocked):
+	"""
+		Returns a string identifying a level, based on its dimensions and
+		its blocked cells.
+	"""
+
+	blocked = numpy.ascontiguousarray(blocked, dtype=numpy.uint8)
+
+	digest = hashlib.sha1()
+	digest.update("{0}x{1}:".format(width, height))
+	digest.update(blocked.tostring())
+
+	return digest.hexdigest()
+
+class VisibilityTable(object):
+	"""
+		Visibility of each cell from each other cell of a level.
+
+		Cells are identified by their flat index ``x * height + y``. Row i
+		of :attr:`bits` contains a packed bitmask with the cells visible
+		from the center of cell i.
+	"""
+
+	# Increment when the contents of the table change, so old files aren't used
+	VERSION = 1
+
+	# Exact line of sight queries snap positions to this fraction of a cell
+	RESOLUTION = 8
+
+	def __init__(self, width, height, bits, blocked=None):
+		self.width = width
+		self.height = height
+		self.bits = bits
+
+		if blocked is None:
+			blocked = numpy.zeros((width, height), dtype=bool)
+		self.blocked = bytearray(numpy.asarray(blocked, dtype=numpy.uint8).tostring())
+
+		# Traced lines of sight, by snapped end points
+		self.lines = LRUCache(4096)
+
+	@classmethod
+	def build(cls, width, height, blocked, processes=None, chunk=64):
+		"""
+			Computes the table with a visibility wave from each cell which
+			doesn't block sight. The origins are split in shards of `chunk`
+			cells, which are divided over a pool of worker processes.
+
+			:Arguments:
+				* width, height: Dimensions of the level
+				* blocked: Boolean array of shape (width, height), True for cells which block sight
+				* processes: Number of worker processes, defaults to the number of CPUs. With 1 the table is built in this process.
+				* chunk: Number of origins per shard
+		"""
+
+		blocked = numpy.asarray(blocked, dtype=bool)
+		size = width * height
+		bits = numpy.zeros((size, (size + 7) // 8), dtype=numpy.uint8)
+
+		bitmap = bytearray(blocked.astype(numpy.uint8).tostring())
+		origins = numpy.flatnonzero(~blocked)
+		shards = [origins[i:i+chunk] for i in xrange(0, len(origins), chunk)]
+
+		if processes is None:
+			try:
+				processes = multiprocessing.cpu_count()
+			except NotImplementedError:
+				processes = 1
+
+		if processes > 1 and len(shards) > 1:
+			pool = multiprocessing.Pool(min(processes, len(shards)), _init_worker, (width, height, bitmap))
+
+			try:
+				for shard, rows in pool.imap_unordered(_compute_rows, shards):
+					bits[shard] = rows
+			finally:
+				pool.terminate()
+				pool.join()
+		else:
+			wave = BitmapWave((width, height), bitmap)
+
+			for shard in shards:
+				shard, rows = _compute_rows(shard, wave)
+				bits[shard] = rows
+
+		return cls(width, height, bits, blocked)
+
+	@classmethod
+	def load(cls, width, height, blocked, directory=CACHE_DIRECTORY, processes=None):
+		"""
+			Returns the table for the given level. If the table has been
+			stored before it is memory-mapped from disk, otherwise it is
+			built with `processes` workers and stored for the next time.
+		"""
+
+		path = join(directory, "visibility-{0}-{1}.npy".format(cls.VERSION, fingerprint(width, height, blocked)))
+
+		if exists(path):
+			return cls(width, height, numpy.load(path, mmap_mode='r'), blocked)
+
+		table = cls.build(width, height, blocked, processes)
+
+		try:
+			if not exists(directory):
+				os.makedirs(directory)
+
+			# Write to a temporary file first, so an interrupted write doesn't leave a broken table
+			numpy.save(path + '.tmp.npy', table.bits)
+			os.rename(path + '.tmp.npy', path)
+		except (IOError, OSError):
+			print >>sys.stderr, "Could not store visibility table..."
+
+		return table
+
+	def is_visible(self, origin, target):
+		"""
+			Returns True if the cell of `target` is visible from the cell of
+			`origin`.
+		"""
+
+		origin = int(origin[0]) * self.height + int(origin[1])
+		target = int(target[0]) * self.height + int(target[1])
+
+		return bool(self.bits.item(origin, target >> 3) & (0x80 >> (target & 7)))
+
+	def has_line_of_sight(self, a, b, exact=False):
+		"""
+			Returns True if position `b` can be seen from position `a`.
+
+			By default this is looked up per cell in the table. With `exact`
+			the segment between both positions is traced through the cells
+			which block sight. Positions are snapped to 1/:attr:`RESOLUTION`
+			of a cell, and traced results are kept in an LRU cache, so
+			repeated queries for the same bots are cheap.
+		"""
+
+		if not exact:
+			return self.is_visible(a, b)
+
+		key = (int(a[0] * self.RESOLUTION + 0.5), int(a[1] * self.RESOLUTION + 0.5),
+			int(b[0] * self.RESOLUTION + 0.5), int(b[1] * self.RESOLUTION + 0.5))
+
+		result = self.lines.get(key)
+		if result is None:
+			result = self.trace(*key)
+			self.lines[key] = result
+
+		return result
+
+	def trace(self, ax, ay, bx, by):
+		"""
+			Walks the cells crossed by the segment between two snapped
+			positions, in the order they are crossed, and returns False if
+			one of them blocks sight. The cell of the start position itself
+			isn't checked.
+		"""
+
+		ax, ay = ax / self.RESOLUTION, ay / self.RESOLUTION
+		bx, by = bx / self.RESOLUTION, by / self.RESOLUTION
+		dx, dy = bx - ax, by - ay
+
+		x, y = int(ax), int(ay)
+		steps = abs(int(bx) - x) + abs(int(by) - y)
+
+		# Distance along the segment between vertical and horizontal cell borders
+		step_x = 1 if dx > 0 else -1
+		step_y = 1 if dy > 0 else -1
+		delta_x = abs(1.0 / dx) if dx else float('inf')
+		delta_y = abs(1.0 / dy) if dy else float('inf')
+
+		# Distance along the segment to the first border, never for an axis the segment doesn't move along
+		next_x = ((x + 1 - ax) if dx > 0 else (ax - x)) * delta_x if dx else float('inf')
+		next_y = ((y + 1 - ay) if dy > 0 else (ay - y)) * delta_y if dy else float('inf')
+
+		for i in xrange(steps):
+			if next_x < next_y:
+				x += step_x
+				next_x += delta_x
+			else:
+				y += step_y
+				next_y += delta_y
+
+			if 0 <= x < self.width and 0 <= y < self.height and self.blocked[x*self.height + y]:
+				return False
+
+		return True
+
+	def lines_of_sight(self, starts, ends):
+		"""
+			Batch version of :meth:`has_line_of_sight` with `exact`, for
+			many pairs of positions at once. Returns a boolean array with
+			True for each segment which doesn't cross a cell which blocks
+			sight. Positions are used as given, without snapping.
+		"""
+
+		if not len(starts):
+			return numpy.zeros(0, dtype=bool)
+
+		segments, xs, ys = rasterize(starts, ends)
+
+		# The start cell of each segment isn't checked, like in trace
+		checked = numpy.ones(len(segments), dtype=bool)
+		checked[0] = False
+		checked[1:] = segments[1:] == segments[:-1]
+		checked &= (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+
+		blocked = numpy.frombuffer(self.blocked, dtype=numpy.uint8)
+		hits = numpy.zeros(len(segments), dtype=bool)
+		hits[checked] = blocked[xs[checked]*self.height + ys[checked]] > 0
+
+		return numpy.bincount(segments, weights=hits, minlength=len(numpy.atleast_2d(starts))) == 0
+
+	def visible_from(self, origin):
+		"""
+			Returns a boolean array of shape (width, height) with all cells
+			visible from the cell of `origin`.
+		"""
+
+		row = self.bits[int(origin[0]) * self.height + int(origin[1])]
+
+		return numpy.unpackbits(row)[:self.width * self.height].reshape((self.width, self.height))
+
+	def coverage(self, radius=None, chunk=256):
+		"""
+			Returns an array of shape (width, height) with, for each cell,
+			the number of cells from which it is visible. When `radius` is
+			given, only origins within that distance are counted.
+		"""
+
+		size = self.width * self.height
+		xs, ys = numpy.divmod(numpy.arange(size), self.height)
+
+		counts = numpy.zeros(size, dtype=numpy.intp)
+		for start in xrange(0, size, chunk):
+			visible = numpy.unpackbits(numpy.asarray(self.bits[start:start+chunk]), axis=1)[:, :size].astype(bool)
+
+			if radius is not None:
+				dx = xs[start:start+chunk, numpy.newaxis] - xs
+				dy = ys[start:start+chunk, numpy.newaxis] - ys
+				visible &= dx*dx + dy*dy <= radius*radius
+
+			counts += visible.sum(axis=0)
+
+		return counts.reshape((self.width, self.height))
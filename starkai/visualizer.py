@@ -45,6 +45,7 @@ class VisualizerWindow(object):
 			'Enemy Influence': 'enemy_influence',
 			'Goal Influence': 'goal_influence',
 			'Visibility': 'visibility',
+			'Threat': 'threat',
 			'Influence': 'influence',
 			'Final Influence': 'final_influence'
 		}
@@ -120,11 +121,11 @@ class VisualizerWindow(object):
 		# Draw blocks
 		for x in range(self.commander.level.width):
 			for y in range(self.commander.level.height):
-				if self.commander.level.blockHeights[x][y] > 2:
+				if self.commander.state.heights[x, y] > 2:
 					self.draw_pixel(ctx, x, y, (0, 0, 0))
-				elif self.commander.level.blockHeights[x][y] > 1:
+				elif self.commander.state.heights[x, y] > 1:
 					self.draw_pixel(ctx, x, y, (0.1, 0.1, 0.1))
-				elif self.commander.level.blockHeights[x][y] > 0:
+				elif self.commander.state.heights[x, y] > 0:
 					self.draw_pixel(ctx, x, y, (0.2, 0.2, 0.2))
 
 		# Draw flag and score locations
@@ -171,9 +172,12 @@ class VisualizerWindow(object):
 			self.draw_line(ctx, bot.position.x, bot.position.y, bot.facingDirection, min(self.scale_x, self.scale_y), color)
 
 		if self.active_map:
+			# Lazy views are evaluated over the whole grid at once
+			values = self.active_map.materialize() if hasattr(self.active_map, 'materialize') else self.active_map
+
 			for x in range(self.commander.level.width):
 				for y in range(self.commander.level.height):
-					value = self.active_map[(x,y)]
+					value = values[(x,y)]
 
 					alpha = math.fabs(value)
 